@@ -0,0 +1,130 @@
+import time
+import argparse
+
+import numpy as np
+import torch
+
+import hrac.hrac as hrac
+import hrac.utils as utils
+from hrac.world_models import EnsembleDynamicsModel, PredictEnv
+
+
+# Updates per second of Manager/Controller.train on random replay data,
+# eager against --compile_updates:
+#   python benchmark_updates.py --controller_algo td3_lag --iterations 500
+# --check_rollout instead checks that the imagination rollout compiles to a
+# single graph per horizon and matches the eager rollout.
+
+
+def fill_controller_buffer(buffer, size, state_dim, goal_dim, action_dim, cost):
+    for _ in range(size):
+        transition = (np.random.randn(state_dim), np.random.randn(state_dim),
+                      np.random.randn(goal_dim), np.random.randn(action_dim),
+                      np.random.randn(), 0.)
+        if cost:
+            transition += (float(np.random.rand() < 0.1),)
+        buffer.add(transition + ([], []))
+
+
+def fill_manager_buffer(buffer, size, state_dim, goal_dim, action_dim, seq_len):
+    for _ in range(size):
+        buffer.add((np.random.randn(state_dim), np.random.randn(state_dim),
+                    np.random.randn(goal_dim), np.random.randn(action_dim),
+                    np.random.randn(), 0.,
+                    [np.random.randn(state_dim) for _ in range(seq_len + 1)],
+                    [np.random.randn(action_dim) for _ in range(seq_len)]))
+
+
+def updates_per_second(train, iterations, warmup):
+    # the first calls include torch.compile tracing, time the steady state
+    train(warmup)
+    start = time.perf_counter()
+    train(iterations)
+    return iterations / (time.perf_counter() - start)
+
+
+def benchmark(args, compile_updates):
+    lag = args.controller_algo in ["td3_lag", "sac_lag"]
+    lagrangian_data = {"pid_kp": 1.0, "pid_ki": 0.01, "pid_kd": 0.01, "pid_d_delay": 10,
+                       "pid_delta_p_ema_alpha": 0.95, "pid_delta_d_ema_alpha": 0.95,
+                       "lagrangian_multiplier_init": 0.}
+    controller_policy = hrac.Controller(
+        state_dim=args.state_dim, goal_dim=2, action_dim=args.action_dim,
+        max_action=1.0, actor_lr=1e-4, critic_lr=1e-3,
+        algo=args.controller_algo, sac_alpha=0.2,
+        use_lagrange=lag, safe_threshold=1.0, lagrangian_data=lagrangian_data,
+        ensemble_critics=args.ensemble_critics, compile_updates=compile_updates)
+    controller_buffer = utils.ReplayBuffer(args.buffer_size, cost_memmory=lag)
+    fill_controller_buffer(controller_buffer, args.buffer_size, args.state_dim, 2,
+                           args.action_dim, lag)
+
+    manager_policy = hrac.Manager(
+        state_dim=args.state_dim, goal_dim=2, action_dim=2, actor_lr=1e-4, critic_lr=1e-3,
+        candidate_goals=10, correction=False, scale=np.ones(2) * 10,
+        ensemble_critics=args.ensemble_critics, compile_updates=compile_updates)
+    manager_buffer = utils.ReplayBuffer(args.buffer_size, seq_len=10)
+    fill_manager_buffer(manager_buffer, args.buffer_size, args.state_dim, 2, 2, 10)
+
+    controller_ups = updates_per_second(
+        lambda n: controller_policy.train(controller_buffer, None, None, n, args.batch_size,
+                                          ep_cost=0. if lag else None),
+        args.iterations, args.warmup)
+    manager_ups = updates_per_second(
+        lambda n: manager_policy.train(controller_policy, manager_buffer, None, n, args.batch_size),
+        args.iterations, args.warmup)
+    return controller_ups, manager_ups
+
+
+def check_rollout(args, img_horizon=5):
+    import torch._dynamo.utils as dynamo_utils
+    controller_policy = hrac.Controller(
+        state_dim=args.state_dim, goal_dim=2, action_dim=args.action_dim,
+        max_action=1.0, actor_lr=1e-4, critic_lr=1e-3, img_horizon=img_horizon,
+        controller_imagination_safety_loss=True, compile_updates=True)
+    world_model = EnsembleDynamicsModel(8, 6, args.state_dim, args.action_dim, 0, 0, 64)
+    world_model.scaler.fit(np.random.randn(100, args.state_dim + args.action_dim))
+    world_model.set_elite_model_idxes(list(range(6)))
+    predict_env = PredictEnv(world_model, "check", "pytorch", False)
+    cost_model = hrac.CostModel(args.state_dim, 2, False, 1, 1., 1e-3)
+    rollout = controller_policy.imagination_rollout(cost_model, predict_env)
+    assert rollout.compiled is not None, "torch.compile is not available"
+
+    state = torch.randn(args.batch_size, args.state_dim, device=utils.device)
+    subgoal = torch.randn(args.batch_size, 2, device=utils.device)
+    mu = torch.as_tensor(world_model.scaler.mu, dtype=torch.float32, device=utils.device)
+    std = torch.as_tensor(world_model.scaler.std, dtype=torch.float32, device=utils.device)
+    members = torch.arange(world_model.network_size, device=utils.device)
+    for horizon in range(1, img_horizon + 1):
+        graphs = dynamo_utils.counters["stats"]["unique_graphs"]
+        _, safeties = rollout(state, subgoal, horizon, mu, std, members, mean_over_members=True)
+        assert dynamo_utils.counters["stats"]["unique_graphs"] - graphs == 1, \
+            "rollout of horizon {} did not compile to one graph".format(horizon)
+        _, eager_safeties = rollout.fn(state, subgoal, horizon, mu, std, members, mean_over_members=True)
+        assert torch.allclose(safeties, eager_safeties, atol=1e-5), \
+            "compiled rollout of horizon {} differs from the eager one".format(horizon)
+    print("imagination rollout compiles: one graph per horizon 1..{}".format(img_horizon))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--controller_algo", default="td3", type=str)
+    parser.add_argument("--ensemble_critics", action='store_true', default=False)
+    parser.add_argument("--state_dim", default=32, type=int)
+    parser.add_argument("--action_dim", default=2, type=int)
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--buffer_size", default=5000, type=int)
+    parser.add_argument("--iterations", default=500, type=int)
+    parser.add_argument("--warmup", default=20, type=int)
+    parser.add_argument("--threads", default=0, type=int)
+    parser.add_argument("--check_rollout", action='store_true', default=False)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.check_rollout:
+        check_rollout(args)
+    else:
+        for compile_updates in [False, True]:
+            controller_ups, manager_ups = benchmark(args, compile_updates)
+            print("compile_updates={}: controller {:.1f} updates/s, manager {:.1f} updates/s".format(
+                compile_updates, controller_ups, manager_ups))
@@ -10,7 +10,9 @@ import numpy as np
 from hrac.models import ControllerActor, ControllerCritic, \
     ManagerActor, ManagerCritic, ControllerSafeModel
 
-from hrac.world_models import EnsembleDynamicsModel, PredictEnv
+from hrac.world_models import EnsembleDynamicsModel, ImaginationRollout, PredictEnv
+from hrac.utils import CompiledUpdate, EncodedRows, MetricsAccumulator, PrefetchSampler, SoftUpdate, \
+    trace_critics
 
 """
 HIRO part adapted from
@@ -36,6 +38,10 @@ def var(tensor, to_device=True):
 def get_tensor(z, to_device=True):
     if z is None:
         return None
+    if torch.is_tensor(z):
+        # already converted by the sampler
+        z = var(z, to_device)
+        return z.unsqueeze(0) if len(z.shape) == 1 else z
     if z[0].dtype == np.dtype("O"):
         return None
     if len(z.shape) == 1:
@@ -44,6 +50,13 @@ def get_tensor(z, to_device=True):
         return var(torch.FloatTensor(z.copy()), to_device)
 
 
+def weighted_mean(loss, weights=None):
+    # importance weights of a prioritized replay sample
+    if weights is None:
+        return loss.mean()
+    return (weights * loss).mean()
+
+
 class Manager(object):
     def __init__(self, state_dim, goal_dim, action_dim, actor_lr,
                  critic_lr, candidate_goals, correction=True,
@@ -53,7 +66,12 @@ class Manager(object):
                  subgoal_grad_clip=0,
                  coef_safety_modelbased=1.0,
                  coef_safety_modelfree=1.0,
-                 lidar_observation=False):
+                 lidar_observation=False,
+                 prefetch_batches=0,
+                 target_update_interval=1,
+                 ensemble_critics=False,
+                 compile_updates=False,
+                 batch_reuse=1):
         self.scale = scale
         self.actor = ManagerActor(state_dim, goal_dim, action_dim,
                                   scale=scale, absolute_goal=absolute_goal).to(device)
@@ -62,8 +80,8 @@ class Manager(object):
         self.actor_target.load_state_dict(self.actor.state_dict())
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
 
-        self.critic = ManagerCritic(state_dim, goal_dim, action_dim).to(device)
-        self.critic_target = ManagerCritic(state_dim, goal_dim, action_dim).to(device)
+        self.critic = ManagerCritic(state_dim, goal_dim, action_dim, ensemble=ensemble_critics).to(device)
+        self.critic_target = ManagerCritic(state_dim, goal_dim, action_dim, ensemble=ensemble_critics).to(device)
 
         self.critic_target.load_state_dict(self.critic.state_dict())
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
@@ -71,8 +89,8 @@ class Manager(object):
 
         self.action_norm_reg = 0
 
-        self.criterion = nn.SmoothL1Loss()
-        # self.criterion = nn.MSELoss()
+        self.criterion = nn.SmoothL1Loss(reduction="none")
+        # self.criterion = nn.MSELoss(reduction="none")
         self.state_dim = state_dim
         self.action_dim = action_dim
         self.candidate_goals = candidate_goals
@@ -89,6 +107,19 @@ class Manager(object):
         self.coef_safety_modelbased = coef_safety_modelbased
         self.coef_safety_modelfree = coef_safety_modelfree
 
+        self.prefetch_batches = prefetch_batches
+        self.batch_reuse = batch_reuse
+        self.soft_update = SoftUpdate([(self.critic, self.critic_target), (self.actor, self.actor_target)],
+                                      update_interval=target_update_interval)
+
+        self.critic_update, self.actor_update = self.critic_loss, self.actor_loss
+        if compile_updates:
+            if hasattr(torch, "compile"):
+                self.critic_update = CompiledUpdate(self.critic_loss)
+                self.actor_update = CompiledUpdate(self.actor_loss)
+            elif not ensemble_critics:
+                trace_critics(self, ["critic", "critic_target"], state_dim, goal_dim, action_dim)
+
     def set_eval(self):
         self.actor.set_eval()
         self.actor_target.set_eval()
@@ -147,70 +178,91 @@ class Manager(object):
         return eval + norm, goal_loss, safety_loss
 
     def off_policy_corrections(self, controller_policy, batch_size, subgoals, x_seq, a_seq):
-        first_x = [x[0] for x in x_seq]
-        last_x = [x[-1] for x in x_seq]
+        # x_seq: (batchsz, seq_len + 1, obs_dim), a_seq: (batchsz, seq_len, action_dim),
+        # segments cut by the episode end are padded by the replay buffer
+        subgoals, x_seq, a_seq = (torch.as_tensor(v, dtype=torch.float32, device=device)
+                                  for v in (subgoals, x_seq, a_seq))
+        first_x = x_seq[:, 0]
+        last_x = x_seq[:, -1]
 
         # Shape: (batchsz, 1, subgoal_dim)
-        diff_goal = (np.array(last_x) - np.array(first_x))[:, np.newaxis, :self.action_dim]
+        diff_goal = (last_x - first_x)[:, None, :self.action_dim]
 
         # Shape: (batchsz, 1, subgoal_dim)
-        original_goal = np.array(subgoals)[:, np.newaxis, :]
-        random_goals = np.random.normal(loc=diff_goal, scale=.5*self.scale[None, None, :self.action_dim],
-                                        size=(batch_size, self.candidate_goals, original_goal.shape[-1]))
-        random_goals = random_goals.clip(-self.scale[:self.action_dim], self.scale[:self.action_dim])
+        original_goal = subgoals[:, None, :]
+        scale = torch.as_tensor(self.scale[:self.action_dim], dtype=torch.float32, device=device)
+        random_goals = diff_goal + .5 * scale * torch.randn(batch_size, self.candidate_goals, 
+                                                            original_goal.shape[-1], device=device)
+        random_goals = torch.max(torch.min(random_goals, scale), -scale)
 
         # Shape: (batchsz, 10, subgoal_dim)
-        candidates = np.concatenate([original_goal, diff_goal, random_goals], axis=1)
-        # print(np.array(x_seq).shape)
-        x_seq = np.array(x_seq)[:, :-1, :]
-        a_seq = np.array(a_seq)
-        seq_len = len(x_seq[0])
-
-        # For ease
-        new_batch_sz = seq_len * batch_size
-        action_dim = a_seq[0][0].shape
-        obs_dim = x_seq[0][0].shape
+        candidates = torch.cat([original_goal, diff_goal, random_goals], dim=1)
+        x_seq = x_seq[:, :-1, :]
+        seq_len = x_seq.shape[1]
         ncands = candidates.shape[1]
 
-        true_actions = a_seq.reshape((new_batch_sz,) + action_dim)
-        observations = x_seq.reshape((new_batch_sz,) + obs_dim)
-        goal_shape = (new_batch_sz, self.action_dim)
+        # every candidate relabelled along its segment, evaluated in one pass
+        # Shape: (batchsz * ncands, seq_len, obs_dim)
+        observations = x_seq[:, None].expand(-1, ncands, -1, -1).reshape(batch_size * ncands, seq_len, -1)
+        goals = controller_policy.multi_subgoal_transition(observations, candidates.reshape(batch_size * ncands, -1))
+        with torch.no_grad():
+            policy_actions = controller_policy.actor_action(observations.reshape(batch_size * ncands * seq_len, -1),
+                                                            goals.reshape(batch_size * ncands * seq_len, -1))
+        policy_actions = policy_actions.reshape(batch_size, ncands, seq_len, -1)
+
+        difference = policy_actions - a_seq[:, None]
+        difference = torch.where(difference != -np.inf, difference, torch.zeros_like(difference))
 
-        policy_actions = np.zeros((ncands, new_batch_sz) + action_dim)
+        logprob = -0.5 * difference.pow(2).sum(dim=(-2, -1))
+        max_indices = torch.argmax(logprob, dim=-1)
 
-        for c in range(ncands):
-            candidate = controller_policy.multi_subgoal_transition(x_seq, candidates[:, c])
-            candidate = candidate.reshape(*goal_shape)
-            policy_actions[c] = controller_policy.select_action(observations, candidate)
+        return candidates[torch.arange(batch_size, device=device), max_indices]
 
-        difference = (policy_actions - true_actions)
-        difference = np.where(difference != -np.inf, difference, 0)
-        difference = difference.reshape((ncands, batch_size, seq_len) + action_dim).transpose(1, 0, 2, 3)
+    def critic_loss(self, state, next_state, goal, subgoal, reward, done, discount, weights=None):
+        noise = torch.zeros_like(subgoal).normal_(0, self.policy_noise)
+        noise = noise.clamp(-self.noise_clip, self.noise_clip)
+        next_action = (self.actor_target(next_state, goal) + noise)
+        next_action = torch.min(next_action, self.actor.scale)
+        next_action = torch.max(next_action, -self.actor.scale)
 
-        logprob = -0.5*np.sum(np.linalg.norm(difference, axis=-1)**2, axis=-1)
-        max_indices = np.argmax(logprob, axis=-1)
+        target_Q1, target_Q2 = self.critic_target(next_state, goal,
+                                      next_action)
 
-        return candidates[np.arange(batch_size), max_indices]
+        target_Q = torch.min(target_Q1, target_Q2)
+        target_Q = reward + (done * discount * target_Q)
+        target_Q_no_grad = target_Q.detach()
+
+        # Get current Q estimate
+        current_Q1, current_Q2 = self.value_estimate(state, goal, subgoal)
+
+        # Compute critic loss
+        critic_loss = weighted_mean(self.criterion(current_Q1, target_Q_no_grad) +\
+                                    self.criterion(current_Q2, target_Q_no_grad), weights)
+        return critic_loss, (target_Q_no_grad - current_Q1).detach()
 
     def train(self, controller_policy, replay_buffer, cost_model, 
               iterations, batch_size=100, discount=0.99,
               tau=0.005, a_net=None, r_margin=None):
-        avg_act_loss, avg_crit_loss = 0., 0.
-        debug_maganer_info = {"sum_manager_actor_grad_norm": 0}
-        if a_net is not None:
-            avg_goal_loss = 0.
-        if self.modelfree_safety:
-            avg_safety_subgoals_loss = 0.
-        else:
-            avg_safety_subgoals_loss = None
-        for it in range(iterations):
-            # Sample replay buffer
-            x, y, g, sgorig, r, d, xobs_seq, a_seq = replay_buffer.sample(batch_size)
+        metrics = MetricsAccumulator()
+        # Sample replay buffer
+        batches = PrefetchSampler(replay_buffer, batch_size, iterations,
+                                  prefetch=self.prefetch_batches, reuse=self.batch_reuse)
+        last_batch = None
+        for batch in batches:
+            reused = batch is last_batch
+            last_batch = batch
+            weights, idxes = None, None
+            if replay_buffer.prioritized:
+                batch, weights, idxes = batch[:-2], batch[-2], batch[-1]
+            x, y, g, sgorig, r, d, xobs_seq, a_seq = batch
             batch_size = min(batch_size, x.shape[0])
 
+            # the controller is fixed while the manager trains, so the
+            # corrected subgoals of a reused batch are still valid
             if self.correction and not self.absolute_goal:
-                sg = self.off_policy_corrections(controller_policy, batch_size,
-                                                 sgorig, xobs_seq, a_seq)
+                if not reused:
+                    sg = self.off_policy_corrections(controller_policy, batch_size,
+                                                     sgorig, xobs_seq, a_seq)
             else:
                 sg = sgorig
 
@@ -223,25 +275,11 @@ class Manager(object):
             reward = get_tensor(r)
             done = get_tensor(1 - d)
 
-            noise = torch.FloatTensor(sgorig).data.normal_(0, self.policy_noise).to(device)
-            noise = noise.clamp(-self.noise_clip, self.noise_clip)
-            next_action = (self.actor_target(next_state, goal) + noise)
-            next_action = torch.min(next_action, self.actor.scale)
-            next_action = torch.max(next_action, -self.actor.scale)
-
-            target_Q1, target_Q2 = self.critic_target(next_state, goal,
-                                          next_action)
-
-            target_Q = torch.min(target_Q1, target_Q2)
-            target_Q = reward + (done * discount * target_Q)
-            target_Q_no_grad = target_Q.detach()
-
-            # Get current Q estimate
-            current_Q1, current_Q2 = self.value_estimate(state, goal, subgoal)
-
-            # Compute critic loss
-            critic_loss = self.criterion(current_Q1, target_Q_no_grad) +\
-                          self.criterion(current_Q2, target_Q_no_grad)
+            critic_loss, td_error = self.critic_update(state, next_state, goal, subgoal, reward, done, 
+                                                       discount, weights)
+            if idxes is not None:
+                assert td_error.shape == (len(idxes), 1), "td_error must be (B, 1)"
+                replay_buffer.update_priorities(idxes.cpu().numpy(), td_error.cpu().numpy())
 
             # Optimize the critic
             self.critic_optimizer.zero_grad()
@@ -249,7 +287,7 @@ class Manager(object):
             self.critic_optimizer.step()
 
             # Compute actor loss
-            actor_loss, goal_loss, safety_subgoals_loss = self.actor_loss(state, goal, a_net, r_margin, cost_model)
+            actor_loss, goal_loss, safety_subgoals_loss = self.actor_update(state, goal, a_net, r_margin, cost_model)
             if not(a_net is None):
                 actor_loss = actor_loss + self.goal_loss_coeff * goal_loss
             if self.modelfree_safety:
@@ -270,33 +308,27 @@ class Manager(object):
                                       max_norm=self.subgoal_grad_clip)
 
             with torch.no_grad():
-                manager_actor_grad_norm = (
-                    sum(p.grad.data.norm(2).item() ** 2 for p in self.actor.parameters() if p.grad is not None) ** 0.5
-                )
-                debug_maganer_info["sum_manager_actor_grad_norm"] += manager_actor_grad_norm                
+                # no parameter may have a gradient yet, which counts as a zero norm
+                grad_norms = [p.grad.norm(2) for p in self.actor.parameters() if p.grad is not None]
+                manager_actor_grad_norm = torch.stack(grad_norms).norm(2) if grad_norms else 0.
+                metrics.add("grad_norm", manager_actor_grad_norm)
 
             self.actor_optimizer.step()
 
-            avg_act_loss += actor_loss
-            avg_crit_loss += critic_loss
+            metrics.add("actor_loss", actor_loss)
+            metrics.add("critic_loss", critic_loss)
             if a_net is not None:
-                avg_goal_loss += goal_loss
+                metrics.add("goal_loss", goal_loss)
             if self.modelfree_safety:
-                avg_safety_subgoals_loss += safety_subgoals_loss
+                metrics.add("safety_subgoals_loss", safety_subgoals_loss)
 
             # Update the frozen target models
-            for param, target_param in zip(self.critic.parameters(),
-                                           self.critic_target.parameters()):
-                target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+            self.soft_update(tau)
 
-            for param, target_param in zip(self.actor.parameters(),
-                                           self.actor_target.parameters()):
-                target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
-
-        debug_maganer_info["sum_manager_actor_grad_norm"] /= iterations
-        if self.modelfree_safety:
-            avg_safety_subgoals_loss = avg_safety_subgoals_loss / iterations
-        return avg_act_loss / iterations, avg_crit_loss / iterations, avg_goal_loss / iterations, avg_safety_subgoals_loss, debug_maganer_info
+        means = metrics.means()
+        debug_maganer_info = {"sum_manager_actor_grad_norm": means["grad_norm"]}
+        return means["actor_loss"], means["critic_loss"], means.get("goal_loss"), \
+               means.get("safety_subgoals_loss"), debug_maganer_info
 
     def load_pretrained_weights(self, filename):
         state = torch.load(filename)
@@ -319,8 +351,10 @@ class Manager(object):
 class CostModel(object):
     def __init__(self, state_dim, goal_dim, lidar_observation, 
                        frame_stack_num, 
-                       safe_model_loss_coef, lr):
+                       safe_model_loss_coef, lr,
+                       prefetch_batches=0):
         self.lidar_observation = lidar_observation
+        self.prefetch_batches = prefetch_batches
         self.safe_model_loss_coef = safe_model_loss_coef        
         self.frame_stack_num = frame_stack_num
         if self.lidar_observation:
@@ -340,13 +374,18 @@ class CostModel(object):
                          cost_model_batch_size=128,
                          train_on_dataset=False,
                          dataset=None):
-        debug_info = {}
-        debug_info["safe_model_loss"] = []
-        debug_info["safe_model_mean_true"] = []
-        debug_info["safe_model_mean_pred"] = []
+        metrics = MetricsAccumulator()
+        if not train_on_dataset:
+            batches = iter(PrefetchSampler(replay_buffer, cost_model_batch_size, cost_model_iterations,
+                                           prefetch=self.prefetch_batches))
         for i in range(cost_model_iterations):
             if train_on_dataset:
-                x = random.sample(dataset[0], cost_model_batch_size)
+                # draw the rows first, lidar-encoded rows are then decoded in one call
+                ind = random.sample(range(len(dataset[0])), cost_model_batch_size)
+                if isinstance(dataset[0], EncodedRows):
+                    x = dataset[0][np.array(ind)]
+                else:
+                    x = [dataset[0][j] for j in ind]
                 x_np = np.array(x, dtype=np.float32)
                 x_tensor = torch.tensor(x_np)
                 state_device = x_tensor.to(device)
@@ -357,27 +396,22 @@ class CostModel(object):
                 cost_device = cost_tensor.to(device)
             else:
                 if replay_buffer.name == "cost_trajectory_buffer":
-                    x, c = replay_buffer.sample(cost_model_batch_size)
-                    state = get_tensor(x, to_device=False) # cost for the next_state
-                    state_device = state.to(device)
-                    cost = get_tensor(c, to_device=False)
-                    cost_device = cost.to(device)
+                    x, c = next(batches)
+                    state_device = get_tensor(x) # cost for the next_state
+                    cost_device = get_tensor(c)
                 elif replay_buffer.cost_memmory:
-                    x, y, sg, u, r, c, d, _, _ = replay_buffer.sample(cost_model_batch_size)
-                    state = get_tensor(y, to_device=False) # cost for the next_state
-                    state_device = state.to(device)
-                    cost = get_tensor(c, to_device=False)
-                    cost_device = cost.to(device)
+                    x, y, sg, u, r, c, d, _, _ = next(batches)
+                    state_device = get_tensor(y) # cost for the next_state
+                    cost_device = get_tensor(c)
                 else:
-                    x, y, sg, u, r, d, _, _ = replay_buffer.sample(cost_model_batch_size)
-                    state = get_tensor(x, to_device=False)
-                    state_device = state.to(device)
+                    x, y, sg, u, r, d, _, _ = next(batches)
+                    state_device = get_tensor(x)
                     cost_device = None
             safe_model_loss, true, pred = self.train_batch_cost_model(state_device, cost=cost_device)
-            debug_info["safe_model_loss"].append(safe_model_loss.mean().cpu().detach())
-            debug_info["safe_model_mean_true"].append(true.float().mean().cpu().detach())
-            debug_info["safe_model_mean_pred"].append(pred.float().mean().cpu().detach())
-        return debug_info
+            metrics.add("safe_model_loss", safe_model_loss.mean())
+            metrics.add("safe_model_mean_true", true.float().mean())
+            metrics.add("safe_model_mean_pred", pred.float().mean())
+        return metrics.means()
     
     def train_batch_cost_model(self, init_state, cost=None):
         pred = self.safe_model(init_state)
@@ -419,22 +453,33 @@ class Controller(object):
                  use_lagrange=False,
                  algo="td3",
                  sac_alpha=None,
-                 lagrangian_data={}
-
+                 lagrangian_data={},
+                 prefetch_batches=0,
+                 target_update_interval=1,
+                 ensemble_critics=False,
+                 compile_updates=False,
+                 batch_reuse=1
     ):
         self.state_dim = state_dim
         self.goal_dim = goal_dim
         self.action_dim = action_dim
         self.max_action = max_action
         self.no_xy = no_xy
+        # zeroes the xy columns of any batch shape of states in clean_obs
+        self.obs_mask = torch.ones(state_dim, device=device)
+        self.obs_mask[:2] = 0
+        self.rollout, self.rollout_key = None, None
+        self.compile_rollout = compile_updates and hasattr(torch, "compile")
         self.policy_noise = policy_noise
         self.noise_clip = noise_clip
         self.absolute_goal = absolute_goal
-        self.criterion = nn.SmoothL1Loss()  
+        self.criterion = nn.SmoothL1Loss(reduction="none")
         self.controller_cumul_img_safety = controller_cumul_img_safety
         self.algo = algo
 
         self.sac_alpha = sac_alpha
+        self.prefetch_batches = prefetch_batches
+        self.batch_reuse = batch_reuse
 
         self.controller_imagination_safety_loss = controller_imagination_safety_loss
         self.controller_safety_coef = controller_safety_coef
@@ -468,13 +513,21 @@ class Controller(object):
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(),
             lr=actor_lr)
 
-        self.critic = ControllerCritic(state_dim, goal_dim, action_dim).to(device)
-        self.critic_target = ControllerCritic(state_dim, goal_dim, action_dim).to(device)
+        # with ensemble critics the cost critic of *_lag is stacked into the
+        # same network as heads 2, 3 and trained by the critic optimizer
+        self.fused_cost_critic = ensemble_critics and self.algo in ["td3_lag", "sac_lag"]
+        n_heads = 4 if self.fused_cost_critic else 2
+        self.critic = ControllerCritic(state_dim, goal_dim, action_dim, 
+                                       ensemble=ensemble_critics, n_heads=n_heads).to(device)
+        self.critic_target = ControllerCritic(state_dim, goal_dim, action_dim, 
+                                              ensemble=ensemble_critics, n_heads=n_heads).to(device)
         self.critic_target.load_state_dict(self.critic.state_dict())
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
             lr=critic_lr, weight_decay=0.0001)
         
         if self.algo in ["td3_lag", "sac_lag"]:
+            self.cost_criterion = nn.SmoothL1Loss(reduction="none")
+        if self.algo in ["td3_lag", "sac_lag"] and not self.fused_cost_critic:
             self.cost_critic = ControllerCritic(
                 state_dim, goal_dim, action_dim
             ).to(device)
@@ -487,21 +540,32 @@ class Controller(object):
             self.cost_critic_optimizer = torch.optim.Adam(
                 self.cost_critic.parameters(), lr=critic_lr, weight_decay=0.0001
             )
-            self.cost_criterion = nn.SmoothL1Loss() 
-
 
-    def clean_obs(self, state, dims=2):
+        target_pairs = [(self.critic, self.critic_target)]
+        if self.algo in ["td3_lag", "sac_lag"] and not self.fused_cost_critic:
+            target_pairs.append((self.cost_critic, self.cost_critic_target))
+        if "td3" in self.algo:
+            target_pairs.append((self.actor, self.actor_target))
+        self.soft_update = SoftUpdate(target_pairs, update_interval=target_update_interval)
+
+        self.critic_update, self.actor_update = self.critic_loss, self.actor_loss
+        if compile_updates:
+            if hasattr(torch, "compile"):
+                self.critic_update = CompiledUpdate(self.critic_loss)
+                self.actor_update = CompiledUpdate(self.actor_loss)
+                # the rollout is compiled on its own (imagination_rollout), tracing it
+                # inside the actor loss would recompile the whole loss per random horizon
+                self.state_safety_on_horizon = torch._dynamo.disable(self.state_safety_on_horizon)
+            elif not ensemble_critics:
+                critics = ["critic", "critic_target"]
+                if self.algo in ["td3_lag", "sac_lag"]:
+                    critics += ["cost_critic", "cost_critic_target"]
+                trace_critics(self, critics, state_dim, goal_dim, action_dim)
+
+    def clean_obs(self, state):
         if self.no_xy:
             with torch.no_grad():
-                mask = torch.ones_like(state)
-                if len(state.shape) == 3:
-                    mask[:, :, :dims] = 0
-                elif len(state.shape) == 2:
-                    mask[:, :dims] = 0
-                elif len(state.shape) == 1:
-                    mask[:dims] = 0
-
-                return state*mask
+                return state * self.obs_mask
         else:
             return state
 
@@ -517,23 +581,40 @@ class Controller(object):
         sg = get_tensor(sg)
         return self.agent.get_action_and_value(state, sg)
 
-    def select_action(self, state, sg, evaluation=False):
+    def actor_action(self, state, sg):
         state = self.clean_obs(get_tensor(state))
         sg = get_tensor(sg)
         if "td3" in self.algo:
-            action = self.actor(state, sg).cpu().data.numpy().squeeze()
+            action = self.actor(state, sg)
         elif "sac" in self.algo:
             action, _ = self.actor.sample_action_logprob(state, sg)
-            action = action.cpu().data.numpy().squeeze()
 
         return action
 
+    def select_action(self, state, sg, evaluation=False):
+        return self.actor_action(state, sg).cpu().data.numpy().squeeze()
+
     def value_estimate(self, state, sg, action):
         state = self.clean_obs(get_tensor(state))
         sg = get_tensor(sg)
         action = get_tensor(action)
         return self.critic(state, sg, action)
     
+    def imagination_rollout(self, cost_model, predict_env):
+        # rollout module over the current actor, world model and cost model
+        key = (id(cost_model.safe_model), id(predict_env.model.ensemble_model))
+        if self.rollout_key != key:
+            self.rollout = ImaginationRollout(self.actor, predict_env.model.ensemble_model, cost_model.safe_model,
+                                              self.obs_mask if self.no_xy else None,
+                                              self.goal_dim, absolute_goal=self.absolute_goal,
+                                              lidar_observation=cost_model.lidar_observation,
+                                              frame_stack_num=cost_model.frame_stack_num)
+            if self.compile_rollout:
+                # the loop over imagined steps is unrolled, one graph per horizon
+                self.rollout = CompiledUpdate(self.rollout, recompile_limit=self.img_horizon + 1)
+            self.rollout_key = key
+        return self.rollout
+
     def state_safety_on_horizon(self, state, actions, 
                             controller_policy, 
                             cost_model, 
@@ -542,70 +623,27 @@ class Controller(object):
                             predict_env=None):
 
         assert not(predict_env is None), "world model must be initialized"
-        manager_proposed_goal = actions.clone()
-        next_img_state = state.clone()
-
-        safety_cost = cost_model.safe_model
-
-        h = 0
         if all_steps_safety:
-            safeties = []    
             horizon = self.img_horizon
         else:
             horizon = random.randint(1, self.img_horizon)
-        img_states = []
-        while h < horizon:
-            img_state = next_img_state
-            img_states.append(img_state)
-            ctrl_actions = controller_policy.actor(controller_policy.clean_obs(img_state), manager_proposed_goal) 
-            next_img_state = predict_env.step(img_state, ctrl_actions, 
-                                                    deterministic=True, 
-                                                    torch_deviced=True)
-            if all_steps_safety:
-                if cost_model.lidar_observation:
-                    if cost_model.frame_stack_num > 1:
-                        part_of_state = []
-                        agent_poses = [img_state_[:, :2] for img_state_ in img_states[h-cost_model.frame_stack_num+1:h+1]]
-                        obstacle_datas = [img_state_[:, -16:] for img_state_ in img_states[h-cost_model.frame_stack_num+1:h+1]]
-                        # if current i < self.frame_stack_num, fill posses, obstacle_datas with zeros
-                        while len(agent_poses) < cost_model.frame_stack_num:
-                            batch_size = agent_poses[0].shape[0]
-                            agent_pose = torch.zeros(batch_size, 2).to(device)
-                            obstacle_data = torch.zeros(batch_size, 16).to(device)
-                            agent_poses.append(agent_pose)
-                            obstacle_datas.append(obstacle_data)
-                        part_of_state = [torch.cat((agent_pose, obstacle_data), dim=1) for agent_pose, obstacle_data in zip(agent_poses, obstacle_datas)]
-                        part_of_state = torch.cat(part_of_state, dim=1)
-                        agent_pose = next_img_state[:, :2]
-                        manager_absolute_goal = torch.cat((agent_pose, part_of_state), dim=1)
-                    else:
-                        agent_pose = next_img_state[:, :2]
-                        obstacle_data = next_img_state[:, -16:]
-                        part_of_state = torch.cat((agent_pose, obstacle_data), dim=1)
-                        manager_absolute_goal = agent_pose
-                        manager_absolute_goal = torch.cat((manager_absolute_goal, part_of_state), dim=1)
-                    safety = safety_cost(manager_absolute_goal)
-                else:
-                    safety = safety_cost(next_img_state)
-                safeties.append(safety)
-            manager_proposed_goal = controller_policy.subgoal_transition(img_state, 
-                                                                         manager_proposed_goal, 
-                                                                         next_img_state)
-            h += 1
+
+        world_model = predict_env.model
+        mu = torch.as_tensor(world_model.scaler.mu, dtype=torch.float32, device=device)
+        std = torch.as_tensor(world_model.scaler.std, dtype=torch.float32, device=device)
+        if predict_env.testing_mean_wm:
+            members = torch.arange(world_model.network_size, device=device)
+        else:
+            members = torch.as_tensor(world_model.elite_model_idxes, dtype=torch.long, device=device)
+        rollout = controller_policy.imagination_rollout(cost_model, predict_env)
+        _, safeties = rollout(state, actions.clone(), horizon, mu, std, members, 
+                              mean_over_members=predict_env.testing_mean_wm, 
+                              all_steps=all_steps_safety)
+
         if not all_steps_safety:
-            if cost_model.lidar_observation:
-                agent_pose = next_img_state[:, :2]
-                obstacle_data = next_img_state[:, -16:]
-                part_of_state = torch.cat((agent_pose, obstacle_data), dim=1)
-                manager_absolute_goal = agent_pose
-                manager_absolute_goal = torch.cat((manager_absolute_goal, part_of_state), dim=1)
-                safety = safety_cost(manager_absolute_goal)
-            else:
-                safety = safety_cost(next_img_state)
+            safety = safeties[-1]
         else:
-            safety = 0
-            for el in safeties:
-                safety += el
+            safety = safeties.sum(0)
             if train:
                 safety /= self.img_horizon
         return safety
@@ -613,14 +651,23 @@ class Controller(object):
     def actor_loss(self, state, sg, init_state, cost_model, predict_env):
         if "td3" in self.algo:
             action = self.actor(state, sg)
-            actor_loss = -self.critic.Q1(state, sg, action).mean()
         elif "sac" in self.algo:
             action, log_prob = self.actor.sample_action_logprob(state, sg)
-            actor_loss = (self.sac_alpha * log_prob - self.critic.Q1(state, sg, action)).mean()
         else:
             assert 1 == 0
+        if self.fused_cost_critic:
+            Q1, C1 = self.critic.heads(state, sg, action, [0, 2])
+        else:
+            Q1 = self.critic.Q1(state, sg, action)
+        if "td3" in self.algo:
+            actor_loss = -Q1.mean()
+        elif "sac" in self.algo:
+            actor_loss = (self.sac_alpha * log_prob - Q1).mean()
         if "lag" in self.algo:
-            safety_loss = self.cost_critic.Q1(state, sg, action).mean()
+            if self.fused_cost_critic:
+                safety_loss = C1.mean()
+            else:
+                safety_loss = self.cost_critic.Q1(state, sg, action).mean()
             actor_loss = (
                 actor_loss + safety_loss * self._cost_penalty
             ) / (1 + self._cost_penalty)
@@ -670,16 +717,72 @@ class Controller(object):
         self._cost_penalty = max(0.0, pid_o)
         self._cost_ds.append(self._cost_d)
 
-    def train(self, replay_buffer, cost_model, predict_env, iterations, batch_size=100, discount=0.99, tau=0.005, ep_cost=None):
-        avg_act_loss, avg_crit_loss = 0., 0.
+    def critic_loss(self, state, sg, action, next_state, next_g, reward, done, cost, discount, weights=None):
+        noise = torch.zeros_like(action).normal_(0, self.policy_noise)
+        if "td3" in self.algo:
+            noise = noise.clamp(-self.noise_clip, self.noise_clip)
+            next_action = (self.actor_target(next_state, next_g) + noise)
+            next_action = torch.min(next_action, self.actor.scale)
+            next_action = torch.max(next_action, -self.actor.scale)
+        elif "sac" in self.algo:
+            with torch.no_grad():
+                next_action, next_log_prob = self.actor.sample_action_logprob(next_state, next_g)
+        if self.fused_cost_critic:
+            target_Q1, target_Q2, target_C1, target_C2 = self.critic_target(next_state, next_g, next_action)
+        else:
+            target_Q1, target_Q2 = self.critic_target(next_state, next_g, next_action)
+        target_Q = torch.min(target_Q1, target_Q2)
+        if "sac" in self.algo:
+            # log-probabilities are (B,), target_Q is (B, 1)
+            target_Q = target_Q - self.sac_alpha * next_log_prob.unsqueeze(-1)
+        target_Q = reward + (done * discount * target_Q)
+        target_Q_no_grad = target_Q.detach()
+
+        # Get current Q estimate
+        current_Qs = self.critic(state, sg, action)
+        current_Q1, current_Q2 = current_Qs[:2]
+
+        # Compute critic loss
+        critic_loss = weighted_mean(self.criterion(current_Q1, target_Q_no_grad) + \
+                                    self.criterion(current_Q2, target_Q_no_grad), weights)
+
+        cost_critic_loss = 0
         if self.algo in ["td3_lag", "sac_lag"]:
-            avg_cost_loss = 0.
+            # Cost critic
+            if not self.fused_cost_critic:
+                target_C1, target_C2 = self.cost_critic_target(
+                    next_state, next_g, next_action
+                )
+            target_C = torch.max(target_C1, target_C2)
+            target_C = cost + (done * discount * target_C)
+            target_C_no_grad = target_C.detach()
+
+            # Get current C estimate
+            if self.fused_cost_critic:
+                current_C1, current_C2 = current_Qs[2:]
+            else:
+                current_C1, current_C2 = self.cost_critic(state, sg, action)
+
+            # Compute cost critic loss
+            cost_critic_loss = weighted_mean(self.cost_criterion(
+                current_C1, target_C_no_grad
+            ) + self.cost_criterion(current_C2, target_C_no_grad), weights)
+
+        return critic_loss, cost_critic_loss, (target_Q_no_grad - current_Q1).detach()
+
+    def train(self, replay_buffer, cost_model, predict_env, iterations, batch_size=100, discount=0.99, tau=0.005, ep_cost=None):
+        metrics = MetricsAccumulator()
         debug_info = {}
-        for _ in range(iterations):      
+        batches = PrefetchSampler(replay_buffer, batch_size, iterations,
+                                  prefetch=self.prefetch_batches, reuse=self.batch_reuse)
+        for batch in batches:      
+            weights, idxes = None, None
+            if replay_buffer.prioritized:
+                batch, weights, idxes = batch[:-2], batch[-2], batch[-1]
             if self.algo in ["td3_lag", "sac_lag"]:        
-                x, y, sg, u, r, d, c, _, _ = replay_buffer.sample(batch_size)
+                x, y, sg, u, r, d, c, _, _ = batch
             else:
-                x, y, sg, u, r, d, _, _ = replay_buffer.sample(batch_size)
+                x, y, sg, u, r, d, _, _ = batch
             init_state = get_tensor(x)
             next_g = get_tensor(self.subgoal_transition(x, sg, y))
             state = self.clean_obs(get_tensor(x))
@@ -688,61 +791,27 @@ class Controller(object):
             done = get_tensor(1 - d)
             reward = get_tensor(r)
             next_state = self.clean_obs(get_tensor(y)) 
-            if self.algo in ["td3_lag", "sac_lag"]: 
-                cost = get_tensor(c)
-            noise = torch.FloatTensor(u).data.normal_(0, self.policy_noise).to(device)
-            if "td3" in self.algo:
-                noise = noise.clamp(-self.noise_clip, self.noise_clip)
-                next_action = (self.actor_target(next_state, next_g) + noise)
-                next_action = torch.min(next_action, self.actor.scale)
-                next_action = torch.max(next_action, -self.actor.scale)
-            elif "sac" in self.algo:
-                with torch.no_grad():
-                    next_action, next_log_prob = self.actor.sample_action_logprob(next_state, next_g)
-            target_Q1, target_Q2 = self.critic_target(next_state, next_g, next_action)
-            target_Q = torch.min(target_Q1, target_Q2)
-            if "sac" in self.algo:
-                target_Q = target_Q - self.sac_alpha * next_log_prob
-            target_Q = reward + (done * discount * target_Q)
-            target_Q_no_grad = target_Q.detach()
-
-            # Get current Q estimate
-            current_Q1, current_Q2 = self.critic(state, sg, action)
-
-            # Compute critic loss
-            critic_loss = self.criterion(current_Q1, target_Q_no_grad) + \
-                        self.criterion(current_Q2, target_Q_no_grad)
-
-            # Optimize the critic
+            cost = get_tensor(c) if self.algo in ["td3_lag", "sac_lag"] else None
+            critic_loss, cost_critic_loss, td_error = self.critic_update(
+                state, sg, action, next_state, next_g, reward, done, cost, discount, weights)
+            if idxes is not None:
+                assert td_error.shape == (len(idxes), 1), "td_error must be (B, 1)"
+                replay_buffer.update_priorities(idxes.cpu().numpy(), td_error.cpu().numpy())
+
+            # Optimize the critic and cost critic, their parameters (or stacked
+            # heads) are disjoint so one backward on the summed losses fills
+            # both gradients, and a compiled loss graph is only run back once
+            separate_cost_critic = self.algo in ["td3_lag", "sac_lag"] and not self.fused_cost_critic
             self.critic_optimizer.zero_grad()
-            critic_loss.backward()
-            self.critic_optimizer.step()
-
-            cost_critic_loss = 0
-            if self.algo in ["td3_lag", "sac_lag"]:
-                # Cost critic
-                target_C1, target_C2 = self.cost_critic_target(
-                    next_state, next_g, next_action
-                )
-                target_C = torch.max(target_C1, target_C2)
-                target_C = cost + (done * discount * target_C)
-                target_C_no_grad = target_C.detach()
-
-                # Get current C estimate
-                current_C1, current_C2 = self.cost_critic(state, sg, action)
-
-                # Compute cost critic loss
-                cost_critic_loss = self.cost_criterion(
-                    current_C1, target_C_no_grad
-                ) + self.cost_criterion(current_C2, target_C_no_grad)
-
-                # Optimize the cost critic
+            if separate_cost_critic:
                 self.cost_critic_optimizer.zero_grad()
-                cost_critic_loss.backward()
+            (critic_loss + cost_critic_loss).backward()
+            self.critic_optimizer.step()
+            if separate_cost_critic:
                 self.cost_critic_optimizer.step()
 
             # Compute actor loss
-            actor_loss = self.actor_loss(state, sg, init_state, cost_model, predict_env)
+            actor_loss = self.actor_update(state, sg, init_state, cost_model, predict_env)
 
             # Optimize the actor
             self.actor_optimizer.zero_grad()
@@ -752,36 +821,25 @@ class Controller(object):
                                     max_norm=self.controller_grad_clip)
             self.actor_optimizer.step()
 
-            avg_act_loss += actor_loss
-            avg_crit_loss += critic_loss
+            metrics.add("actor_loss", actor_loss)
+            metrics.add("critic_loss", critic_loss)
             if self.algo in ["td3_lag", "sac_lag"]:
-                avg_cost_loss += cost_critic_loss
+                metrics.add("cost_critic_loss", cost_critic_loss)
             
             # Update the target models
-            for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-                target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
-            if self.algo in ["td3_lag", "sac_lag"]:
-                for param, target_param in zip(
-                    self.cost_critic.parameters(),
-                    self.cost_critic_target.parameters()
-                ):
-                    target_param.data.copy_(
-                        tau * param.data + (1 - tau) * target_param.data
-                    )
-            if "td3" in self.algo:
-                for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-                    target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+            self.soft_update(tau)
 
             if self.use_lagrange and ep_cost is not None:
                 self.pid_update(ep_cost)
 
+        means = metrics.means()
         if self.algo in ["td3_lag", "sac_lag"]:
-            debug_info["controller_critic_loss"] = avg_cost_loss / iterations
+            debug_info["controller_critic_loss"] = means["cost_critic_loss"]
 
         if self.use_lagrange and ep_cost is not None:
             debug_info["lagrangian"] = self._cost_penalty
 
-        return avg_act_loss / iterations, avg_crit_loss / iterations, debug_info
+        return means["actor_loss"], means["critic_loss"], debug_info
 
     def save(self, dir, env_name, algo, exp_num):
         torch.save(self.actor.state_dict(), "{}/{}/{}_{}_ControllerActor.pth".format(dir, exp_num, env_name, algo))
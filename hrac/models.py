@@ -6,6 +6,8 @@ import torch.nn.functional as F
 import numpy as np
 from torch.distributions.normal import Normal
 
+from hrac.world_models import EnsembleFC
+
 #torch.set_default_tensor_type(torch.cuda.FloatTensor)
 #device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -111,6 +113,40 @@ class Critic(nn.Module):
         return x1
     
 
+class EnsembleCritic(nn.Module):
+    # n_heads Q networks of the same shape as Critic, evaluated together with
+    # one batched matmul per layer. Heads 0 and 1 are the twin Q1/Q2, a cost
+    # critic stacked on top of them adds heads 2 and 3.
+    def __init__(self, state_dim, goal_dim, action_dim, hidden_dim=300, n_heads=2):
+        super(EnsembleCritic, self).__init__()
+        self.n_heads = n_heads
+        self.l1 = EnsembleFC(state_dim + goal_dim + action_dim, hidden_dim, n_heads)
+        self.l2 = EnsembleFC(hidden_dim, hidden_dim, n_heads)
+        self.l3 = EnsembleFC(hidden_dim, 1, n_heads)
+        # same init as nn.Linear, per head
+        for layer in (self.l1, self.l2, self.l3):
+            bound = 1 / np.sqrt(layer.in_features)
+            nn.init.uniform_(layer.weight, -bound, bound)
+            nn.init.uniform_(layer.bias, -bound, bound)
+
+    def heads(self, x, g=None, u=None, idx=None):
+        if g is not None:
+            xu = torch.cat([x, g, u], 1)
+        else:
+            xu = torch.cat([x, u], 1)
+        idx = slice(None) if idx is None else idx
+        h = xu.unsqueeze(0).expand(len(self.l1.weight[idx]), -1, -1)
+        for layer in (self.l1, self.l2):
+            h = F.relu(torch.baddbmm(layer.bias[idx][:, None, :], h, layer.weight[idx]))
+        return torch.baddbmm(self.l3.bias[idx][:, None, :], h, self.l3.weight[idx])
+
+    def forward(self, x, g=None, u=None):
+        return tuple(self.heads(x, g, u))
+
+    def Q1(self, x, g=None, u=None):
+        return self.heads(x, g, u, [0])[0]
+
+
 class SafeCritic(nn.Module):
     def __init__(self, state_dim, hidden_dim=300):
         super().__init__()
@@ -161,10 +197,13 @@ class ControllerActor(nn.Module):
 
 
 class ControllerCritic(nn.Module):
-    def __init__(self, state_dim, goal_dim, action_dim):
+    def __init__(self, state_dim, goal_dim, action_dim, ensemble=False, n_heads=2):
         super().__init__()
 
-        self.critic = Critic(state_dim, goal_dim, action_dim)
+        if ensemble:
+            self.critic = EnsembleCritic(state_dim, goal_dim, action_dim, n_heads=n_heads)
+        else:
+            self.critic = Critic(state_dim, goal_dim, action_dim)
     
     def forward(self, x, sg, u):
         return self.critic(x, sg, u)
@@ -172,6 +211,9 @@ class ControllerCritic(nn.Module):
     def Q1(self, x, sg, u):
         return self.critic.Q1(x, sg, u)
 
+    def heads(self, x, sg, u, idx=None):
+        return self.critic.heads(x, sg, u, idx)
+
 
 class ManagerActor(nn.Module):
     def __init__(self, state_dim, goal_dim, action_dim, scale=None, absolute_goal=False):
@@ -190,9 +232,12 @@ class ManagerActor(nn.Module):
 
 
 class ManagerCritic(nn.Module):
-    def __init__(self, state_dim, goal_dim, action_dim):
+    def __init__(self, state_dim, goal_dim, action_dim, ensemble=False):
         super().__init__()
-        self.critic = Critic(state_dim, goal_dim, action_dim)
+        if ensemble:
+            self.critic = EnsembleCritic(state_dim, goal_dim, action_dim)
+        else:
+            self.critic = Critic(state_dim, goal_dim, action_dim)
 
     def forward(self, x, g, u):
         return self.critic(x, g, u)
@@ -1,7 +1,6 @@
 import os
 import time
 import copy
-from math import ceil
 from collections import deque
 
 import torch
@@ -325,46 +324,50 @@ def get_reward_function(dims, absolute_goal=False, binary_reward=False):
     return controller_reward
 
 
-def update_amat_and_train_anet(n_states, adj_mat, state_list, state_dict, a_net, traj_buffer,
+def update_amat_and_train_anet(graph, a_net, traj_buffer,
         optimizer_r, controller_goal_dim, device, args,
         exp_num):
     print("train anet")
     for traj in traj_buffer.get_trajectory():
-        for i in range(len(traj)):
-            for j in range(1, min(args.manager_propose_freq, len(traj) - i)):                
-                s_i = traj[i][:controller_goal_dim]
-                s_i_j = traj[i+j][:controller_goal_dim]
-                if args.domain_name == "Safexp" and args.a_net_new_discretization_safety_gym:
-                    if "1" in args.task_name:
-                        xy_min_max = 2
-                    elif "2" in args.task_name:
-                        xy_min_max = 5
-                    else:
-                        assert 1 == 0
-                    if args.clip_a_net_xy:
-                        s_i = np.clip(s_i, a_min=-xy_min_max, a_max=xy_min_max) * args.a_net_discretization_koef
-                        s_i_j = np.clip(s_i_j, a_min=-xy_min_max, a_max=xy_min_max) * args.a_net_discretization_koef
-                    else:
-                        s_i = (s_i) * args.a_net_discretization_koef # from -1.5, 1.5 to 0, 30
-                        s_i_j = (s_i_j) * args.a_net_discretization_koef # from -1.5, 1.5 to 0, 30
-                s1 = tuple(np.round(s_i).astype(np.int32))
-                s2 = tuple(np.round(s_i_j).astype(np.int32))
-                if s1 not in state_list:
-                    state_list.append(s1)
-                    state_dict[s1] = n_states
-                    n_states += 1
-                if s2 not in state_list:
-                    state_list.append(s2)
-                    state_dict[s2] = n_states
-                    n_states += 1
-                adj_mat[state_dict[s1], state_dict[s2]] = 1
-                adj_mat[state_dict[s2], state_dict[s1]] = 1
-    print("Explored states: {}".format(n_states))
+        if len(traj) < 2:
+            continue
+        # every state is discretized once, the pairs (i, i + j) with
+        # 0 < j < manager_propose_freq come from a broadcast window
+        goals = np.asarray(traj, dtype=np.float64)[:, :controller_goal_dim]
+        if args.domain_name == "Safexp" and args.a_net_new_discretization_safety_gym:
+            if "1" in args.task_name:
+                xy_min_max = 2
+            elif "2" in args.task_name:
+                xy_min_max = 5
+            else:
+                assert 1 == 0
+            if args.clip_a_net_xy:
+                goals = np.clip(goals, a_min=-xy_min_max, a_max=xy_min_max)
+            goals = goals * args.a_net_discretization_koef # from -1.5, 1.5 to 0, 30
+        cells = np.round(goals).astype(np.int32)
+        i = np.arange(len(cells))[:, None]
+        i_j = i + np.arange(1, args.manager_propose_freq)[None, :]
+        in_traj = i_j < len(cells)
+        graph.add_edges(cells[np.broadcast_to(i, i_j.shape)[in_traj]], cells[i_j[in_traj]])
+    print("Explored states: {}".format(graph.n_states))
     print("Training adjacency network...")
-    loss = utils.train_adj_net(a_net, state_list, adj_mat[:n_states, :n_states],
-                        optimizer_r, args.r_margin_pos, args.r_margin_neg,
-                        n_epochs=args.r_training_epochs, batch_size=args.r_batch_size,
-                        device=device, verbose=False, args=args)
+    # few large minibatches drawn on the device, r_train_batch_size=0 keeps the r_batch_size ones
+    batch_size = args.r_train_batch_size or args.r_batch_size
+    if args.r_incremental:
+        # fixed budget per update (r_incremental_batches of r_batch_size pairs),
+        # half of it on what is new since the last one
+        loss = utils.train_adj_net(a_net, graph,
+                            optimizer_r, args.r_margin_pos, args.r_margin_neg,
+                            n_epochs=1, batch_size=batch_size,
+                            device=device, verbose=False, args=args,
+                            n_batches=-(-args.r_incremental_batches * args.r_batch_size // batch_size),
+                            new_fraction=0.5)
+    else:
+        loss = utils.train_adj_net(a_net, graph,
+                            optimizer_r, args.r_margin_pos, args.r_margin_neg,
+                            n_epochs=args.r_training_epochs, batch_size=batch_size,
+                            device=device, verbose=False, args=args)
+    graph.mark_trained()
 
     if args.save_models:
         r_filename = os.path.join(f"./models/{exp_num}", "{}_{}_a_network.pth".format(args.env_name, args.algo))
@@ -373,7 +376,7 @@ def update_amat_and_train_anet(n_states, adj_mat, state_list, state_dict, a_net,
 
     traj_buffer.reset()
 
-    return n_states, loss
+    return loss
 
 
 def run_hrac(args):
@@ -419,7 +422,10 @@ def run_hrac(args):
                 env.seed(seed_)
                 print("get safedataset safetygym!!!", f"seed={seed_}")
                 start_time = time.time()
-                safe_dataset.extend(get_safetydataset_as_random_experience(env, frame_stack_num=args.cm_frame_stack_num))
+                states, costs, hazard_poses = get_safetydataset_as_random_experience(env, frame_stack_num=args.cm_frame_stack_num)
+                if args.lidar_codec:
+                    states = utils.EncodedRows(utils.LidarCodec.for_cost_model(args.lidar_codec, args.cm_frame_stack_num), states)
+                safe_dataset.extend((states, costs, hazard_poses))
                 end_time = time.time()
                 print("time for safe dataset:", end_time-start_time)
             env.safe_dataset = safe_dataset
@@ -533,7 +539,12 @@ def run_hrac(args):
             coef_safety_modelfree=args.coef_safety_modelfree,
             testing_mean_wm=args.testing_mean_wm,
             subgoal_grad_clip=args.subgoal_grad_clip,
-            lidar_observation=True if args.domain_name == "Safexp" else False
+            lidar_observation=True if args.domain_name == "Safexp" else False,
+            prefetch_batches=args.prefetch_batches,
+            target_update_interval=args.target_update_interval,
+            ensemble_critics=args.ensemble_critics,
+            compile_updates=args.compile_updates,
+            batch_reuse=args.man_batch_reuse
         )
     else:
         manager_policy = None
@@ -576,7 +587,12 @@ def run_hrac(args):
         use_lagrange=args.controller_use_lagrange,
         algo=args.controller_algo,
         sac_alpha=args.sac_alpha,
-        lagrangian_data=lagrangian_data
+        lagrangian_data=lagrangian_data,
+        prefetch_batches=args.prefetch_batches,
+        target_update_interval=args.target_update_interval,
+        ensemble_critics=args.ensemble_critics,
+        compile_updates=args.compile_updates,
+        batch_reuse=args.ctrl_batch_reuse
     )
 
     calculate_controller_reward = get_reward_function(
@@ -590,22 +606,93 @@ def run_hrac(args):
         man_noise = utils.NormalNoise(sigma=args.man_noise_sigma)
         ctrl_noise = utils.NormalNoise(sigma=args.ctrl_noise_sigma)
 
+    opened_buffers = []
+    if args.memmap_buffers:
+        replay_dir = os.path.join("./models", str(exp_num), "replay")
+        # resumed runs reopen the loaded replay in place, --copy_loaded_replay
+        # copies it first and leaves the loaded experiment untouched
+        loaded_replay_dir = os.path.join("./models", str(args.loaded_exp_num), "replay") if args.load else None
+
+    def make_buffer(buffer_cls, memmap_buffer_cls, name, prioritized=False, shared_dims=None, **kwargs):
+        if prioritized and args.prioritized_replay:
+            buffer = utils.PrioritizedReplayBuffer(alpha=args.per_alpha, beta=args.per_beta, **kwargs)
+        elif args.memmap_buffers:
+            buffer = memmap_buffer_cls(os.path.join(replay_dir, name),
+                                       source=os.path.join(loaded_replay_dir, name) if loaded_replay_dir else None,
+                                       copy_source=args.copy_loaded_replay, **kwargs)
+        elif args.shared_memory_buffers and shared_dims is not None:
+            buffer = utils.SharedMemoryReplayBuffer(**shared_dims, **kwargs)
+        # the cost model trajectory buffer builds its pairs in NumPy and stays on the host
+        elif args.device_buffers and buffer_cls is utils.ReplayBuffer:
+            buffer = utils.TorchReplayBuffer(**kwargs)
+        else:
+            buffer = buffer_cls(**kwargs)
+        opened_buffers.append(buffer)
+        return buffer
+
+    def flush_buffers():
+        # called on every evaluation and at the end, --memmap_buffers implies --save_models
+        if args.memmap_buffers:
+            for buffer in opened_buffers:
+                buffer.flush()
+
+    def close_buffers():
+        # shared memory blocks outlive the process unless unlinked
+        for buffer in opened_buffers:
+            if isinstance(buffer, utils.SharedMemoryReplayBuffer):
+                buffer.close()
+
+    # compact lidar channels of SafeGym observations
+    obs_codec = utils.LidarCodec(args.lidar_codec) if args.lidar_codec else None
+
+    if args.obs_store:
+        # every buffer only references observations from its own horizon of env steps,
+        # the margin covers the extra reset observation of each episode. The manager's
+        # x_seq references every step of its horizon, so that term usually sets the size
+        obs_store_horizon = max(args.ctrl_buffer_size, args.traj_buffer_size,
+                                args.wm_buffer_size if args.world_model else 0,
+                                0 if args.train_only_td3 else args.man_buffer_size * args.manager_propose_freq)
+        obs_store = make_buffer(utils.ObservationStore, utils.MemmapObservationStore, "obs_store",
+                                maxsize=1.1 * obs_store_horizon, codec=obs_codec)
+    else:
+        obs_store = None
+
+    def store_obs(obs_):
+        if obs_store is None:
+            return obs_
+        return obs_store.add(obs_)
+
     if not args.train_only_td3:
-        manager_buffer = utils.ReplayBuffer(maxsize=args.man_buffer_size)
-    controller_buffer = utils.ReplayBuffer(maxsize=args.ctrl_buffer_size, 
-                                           cost_memmory=(args.controller_algo=="td3_lag" \
-                                                            or args.controller_algo=="sac_lag"))
+        manager_buffer = make_buffer(utils.ReplayBuffer, utils.MemmapReplayBuffer, "manager", prioritized=True,
+                                     shared_dims=dict(state_dim=state_dim, goal_dim=goal_dim, action_dim=controller_goal_dim,
+                                                      seq_action_dim=action_dim),
+                                     maxsize=args.man_buffer_size, obs_store=obs_store,
+                                     seq_len=args.manager_propose_freq, codec=obs_codec)
+    controller_buffer = make_buffer(utils.ReplayBuffer, utils.MemmapReplayBuffer, "controller", prioritized=True,
+                                    shared_dims=dict(state_dim=state_dim, goal_dim=controller_goal_dim, action_dim=action_dim),
+                                    maxsize=args.ctrl_buffer_size, 
+                                    cost_memmory=(args.controller_algo=="td3_lag" \
+                                                    or args.controller_algo=="sac_lag"),
+                                    obs_store=obs_store, codec=obs_codec)
+
+    ## Update-to-data schedules of the learners
+    ctrl_schedule = utils.UpdateSchedule(args.ctrl_utd, args.ctrl_update_cadence, 
+                                         args.ctrl_update_every, args.ctrl_update_budget)
+    man_schedule = utils.UpdateSchedule(args.man_utd if args.man_utd is not None else 1. / args.train_manager_freq, 
+                                        args.man_update_cadence, args.man_update_every, args.man_update_budget)
+    cm_schedule = utils.UpdateSchedule(args.cm_utd, "step" if args.cm_train_freq else "episode", 
+                                       args.cm_train_freq, args.cm_update_budget)
+    # a world model update is a full fit, every wm_train_freq episodes
+    wm_schedule = utils.UpdateSchedule(None, "episode", args.wm_train_freq)
 
     ## Train TD3 controller
-    def train_controller(controller_buffer, next_done, next_state, subgoal, episode_timesteps, 
-                         ep_controller_reward, episode_cost, man_episode_cost, episode_safety_subgoal_rate, 
-                         ep_manager_reward, total_timesteps, pid_costs=None):
+    def train_controller(iterations, total_timesteps, pid_costs=None):
         print("train controller")
         ctrl_act_loss, ctrl_crit_loss, debug_info_controller = controller_policy.train(
             controller_buffer, 
             cost_model=cost_model,
             predict_env=predict_env,
-            iterations=episode_timesteps,
+            iterations=iterations,
             batch_size=args.ctrl_batch_size, 
             discount=args.ctrl_discount, 
             tau=args.ctrl_soft_sync_rate,
@@ -621,21 +708,42 @@ def run_hrac(args):
             writer.add_scalar(f"data/{key_}", debug_info_controller[key_], total_timesteps)
 
         writer.add_scalar(f"data/controller_buffer_size", len(controller_buffer), total_timesteps)
-        writer.add_scalar("data/controller_ep_cost", episode_cost, total_timesteps)
-        writer.add_scalar("data/controller_ep_rew", ep_controller_reward, total_timesteps)
-        writer.add_scalar("data/manager_ep_rew", ep_manager_reward, total_timesteps)
-        writer.add_scalar("data/manager_ep_cost", man_episode_cost, total_timesteps)
-        writer.add_scalar("data/manager_ep_safety_subgoal_rate", episode_safety_subgoal_rate, total_timesteps)
+
+    ## Train manager
+    def train_manager(iterations, total_timesteps):
+        r_margin = (args.r_margin_pos + args.r_margin_neg) / 2
+
+        print("train subgoal policy")
+        man_act_loss, man_crit_loss, man_goal_loss, man_safety_loss, debug_maganer_info = \
+                            manager_policy.train(controller_policy,
+                                                 manager_buffer, 
+                                                 cost_model,
+                                                 iterations,
+                                                 batch_size=args.man_batch_size, 
+                                                 discount=args.man_discount, 
+                                                 tau=args.man_soft_sync_rate,
+                                                 a_net=a_net, r_margin=r_margin)
+        
+        writer.add_scalar("data/manager_actor_loss", man_act_loss, total_timesteps)
+        writer.add_scalar("data/manager_critic_loss", man_crit_loss, total_timesteps)
+        writer.add_scalar("data/manager_goal_loss", man_goal_loss, total_timesteps)
+        for key_ in debug_maganer_info:
+            if type(debug_maganer_info[key_]) == list:
+                debug_maganer_info[key_] = np.mean(debug_maganer_info[key_])
+            writer.add_scalar(f"data/{key_}", debug_maganer_info[key_], total_timesteps)
+        if not(man_safety_loss is None):
+            writer.add_scalar("data/manager_safety_loss", man_safety_loss, total_timesteps)
+
+        if episode_num % 10 == 0:
+            print("Manager actor loss: {:.3f}".format(man_act_loss))
+            print("Manager critic loss: {:.3f}".format(man_crit_loss))
+            print("Manager goal loss: {:.3f}".format(man_goal_loss))
+            if not(man_safety_loss is None):
+                print("Manager safety loss: {:.3f}".format(man_safety_loss))
 
     ## Initialize adjacency matrix and adjacency network
-    n_states = 0
-    state_list = []
-    state_dict = {}
-    if args.domain_name == "Safexp" and args.a_net_new_discretization_safety_gym:
-        adj_mat = np.diag(np.ones(3000, dtype=np.uint8))
-    else:
-        adj_mat = np.diag(np.ones(1500, dtype=np.uint8))
-    traj_buffer = utils.TrajectoryBuffer(capacity=args.traj_buffer_size)
+    graph = utils.AdjacencyGraph(controller_goal_dim)
+    traj_buffer = utils.TrajectoryBuffer(capacity=args.traj_buffer_size, obs_store=obs_store)
     a_net = ANet(controller_goal_dim, args.r_hidden_dim, args.r_embedding_dim)
     if args.load_adj_net:
         print("Loading adjacency network...")
@@ -665,11 +773,18 @@ def run_hrac(args):
                                         lidar_observation=True if args.domain_name == "Safexp" else False, 
                                         frame_stack_num=args.cm_frame_stack_num,
                                         safe_model_loss_coef=args.safe_model_loss_coef, 
-                                        lr=args.cm_lr)
+                                        lr=args.cm_lr,
+                                        prefetch_batches=args.prefetch_batches)
         if args.domain_name == "Safexp":
             if not args.cost_oracle:
-                cost_model_buffer = utils.CostModelTrajectoryBuffer(maxsize=args.cost_model_buffer_size, 
-                                                                    frame_stack_num=args.cm_frame_stack_num)
+                cost_model_buffer = make_buffer(utils.CostModelTrajectoryBuffer, 
+                                                utils.MemmapCostModelTrajectoryBuffer, "cost_model",
+                                                maxsize=args.cost_model_buffer_size, 
+                                                frame_stack_num=args.cm_frame_stack_num,
+                                                obs_store=obs_store,
+                                                reservoir_size=args.cm_reservoir_size,
+                                                codec=utils.LidarCodec.for_cost_model(args.lidar_codec, args.cm_frame_stack_num) \
+                                                        if args.lidar_codec else None)
             
         def train_cost_model(replay_buffer,
                              cost_model_iterations=10,
@@ -701,7 +816,9 @@ def run_hrac(args):
                                               reward_size, cost_size, pred_hidden_size,
                                               learning_rate=learning_rate, use_decay=use_decay)
             predict_env = PredictEnv(env_model, env_name, model_type, args.testing_mean_wm)
-        world_model_buffer = utils.ReplayBuffer(maxsize=args.wm_buffer_size, cost_memmory=args.cost_memmory)
+        world_model_buffer = make_buffer(utils.ReplayBuffer, utils.MemmapReplayBuffer, "world_model",
+                                         maxsize=args.wm_buffer_size, cost_memmory=args.cost_memmory,
+                                         obs_store=obs_store, codec=obs_codec)
             
         def train_world_model(replay_buffer, acc_wm_imagination_episode_metric, batch_size=256, 
                               episode_num=0, total_timesteps=0):
@@ -772,6 +889,7 @@ def run_hrac(args):
                     if done:
                         obs = env.reset()
                         state = obs["observation"]
+                        state_ref = store_obs(state)
                         done = False
                         if args.domain_name == "Safexp" and args.cost_model:
                             if not args.cost_oracle:
@@ -781,17 +899,19 @@ def run_hrac(args):
                     action = env.action_space.sample()
                     next_tup, manager_reward, done, info = env.step(action)   
                     next_state = next_tup["observation"]
+                    next_state_ref = store_obs(next_state)
                     if args.world_model:
                         if world_model_buffer.cost_memmory:
                             world_model_buffer.add(
-                            (state, next_state, None, action, None, info["safety_cost"], None, [], [])) 
+                            (state_ref, next_state_ref, None, action, None, info["safety_cost"], None, [], [])) 
                         else:
                             world_model_buffer.add(
-                                (state, next_state, None, action, None, None, [], [])) 
+                                (state_ref, next_state_ref, None, action, None, None, [], [])) 
                     if args.domain_name == "Safexp" and args.cost_model:
                         if not args.cost_oracle:
-                            cost_model_buffer.append(next_state, info["safety_cost"])
+                            cost_model_buffer.append(next_state_ref, info["safety_cost"])
                     state = next_state
+                    state_ref = next_state_ref
                     exploration_total_timesteps += 1
 
 
@@ -821,7 +941,6 @@ def run_hrac(args):
         ## Logging Parameters
         total_timesteps = 0
         timesteps_since_eval = 0
-        timesteps_since_manager = 0
         episode_timesteps = 0
         timesteps_since_subgoal = 0
         episode_num = 0
@@ -840,19 +959,22 @@ def run_hrac(args):
                         print("Episode {}".format(episode_num))
                         
                     ## Train World Model or Cost Model
-                    if args.cost_model and not args.cost_oracle:
+                    n_updates = cm_schedule.end_episode()
+                    if args.cost_model and not args.cost_oracle and n_updates:
                         if args.domain_name == "Safexp":
                             buffer = cost_model_buffer
                         else:
                             buffer = world_model_buffer
-                        train_cost_model(buffer,
-                                        cost_model_iterations=episode_timesteps,
-                                        cost_model_batch_size=args.cost_model_batch_size,
-                                        total_timesteps=total_timesteps,
-                                        train_on_dataset=args.cm_train_on_dataset,
-                                        dataset=env.safe_dataset if env_name == "SafeGym" else None)
+                        cm_schedule.run(lambda n: train_cost_model(buffer,
+                                                                  cost_model_iterations=n,
+                                                                  cost_model_batch_size=args.cost_model_batch_size,
+                                                                  total_timesteps=total_timesteps,
+                                                                  train_on_dataset=args.cm_train_on_dataset,
+                                                                  dataset=env.safe_dataset if env_name == "SafeGym" else None),
+                                        n_updates)
                             
-                    if args.world_model and (episode_num == 1 or (episode_num % args.wm_train_freq == 0)):
+                    wm_due = wm_schedule.end_episode()
+                    if args.world_model and (episode_num == 1 or wm_due):
                         train_world_model(world_model_buffer, acc_wm_imagination_episode_metric, 
                                           batch_size=args.wm_batch_size, 
                                           episode_num=episode_num,
@@ -860,50 +982,24 @@ def run_hrac(args):
                     
                     ## Train TD3 controller             
                     if args.train_only_td3:
-                        controller_subgoal = goal[:2] - state[:2]
                         episode_safety_subgoal_rate_ = 0  
                     else:
-                        controller_subgoal = subgoal
                         episode_safety_subgoal_rate_ = episode_safety_subgoal_rate/episode_subgoals_count     
-                    train_controller(controller_buffer, ctrl_done, next_state, controller_subgoal, 
-                                    episode_timesteps, 
-                                    ep_controller_reward, controller_episode_cost, episode_cost, 
-                                    episode_safety_subgoal_rate_, 
-                                    ep_manager_reward, total_timesteps,
-                                    pid_costs=pid_costs if controller_policy.use_lagrange else None)
+                    n_updates = ctrl_schedule.end_episode()
+                    if n_updates:
+                        ctrl_schedule.run(lambda n: train_controller(n, total_timesteps, 
+                                            pid_costs=pid_costs if controller_policy.use_lagrange else None),
+                                          n_updates)
+                    writer.add_scalar("data/controller_ep_cost", controller_episode_cost, total_timesteps)
+                    writer.add_scalar("data/controller_ep_rew", ep_controller_reward, total_timesteps)
+                    writer.add_scalar("data/manager_ep_rew", ep_manager_reward, total_timesteps)
+                    writer.add_scalar("data/manager_ep_cost", episode_cost, total_timesteps)
+                    writer.add_scalar("data/manager_ep_safety_subgoal_rate", episode_safety_subgoal_rate_, total_timesteps)
 
                     ## Train manager
-                    if not args.train_only_td3 and timesteps_since_manager >= args.train_manager_freq:
-                        timesteps_since_manager = 0
-                        r_margin = (args.r_margin_pos + args.r_margin_neg) / 2
-
-                        print("train subgoal policy")
-                        man_act_loss, man_crit_loss, man_goal_loss, man_safety_loss, debug_maganer_info = \
-                                            manager_policy.train(controller_policy,
-                                                                 manager_buffer, 
-                                                                 cost_model,
-                                                                 ceil(episode_timesteps/args.train_manager_freq),
-                                                                 batch_size=args.man_batch_size, 
-                                                                 discount=args.man_discount, 
-                                                                 tau=args.man_soft_sync_rate,
-                                                                 a_net=a_net, r_margin=r_margin)
-                        
-                        writer.add_scalar("data/manager_actor_loss", man_act_loss, total_timesteps)
-                        writer.add_scalar("data/manager_critic_loss", man_crit_loss, total_timesteps)
-                        writer.add_scalar("data/manager_goal_loss", man_goal_loss, total_timesteps)
-                        for key_ in debug_maganer_info:
-                            if type(debug_maganer_info[key_]) == list:
-                                debug_maganer_info[key_] = np.mean(debug_maganer_info[key_])
-                            writer.add_scalar(f"data/{key_}", debug_maganer_info[key_], total_timesteps)
-                        if not(man_safety_loss is None):
-                            writer.add_scalar("data/manager_safety_loss", man_safety_loss, total_timesteps)
-
-                        if episode_num % 10 == 0:
-                            print("Manager actor loss: {:.3f}".format(man_act_loss))
-                            print("Manager critic loss: {:.3f}".format(man_crit_loss))
-                            print("Manager goal loss: {:.3f}".format(man_goal_loss))
-                            if not(man_safety_loss is None):
-                                print("Manager safety loss: {:.3f}".format(man_safety_loss))
+                    n_updates = man_schedule.end_episode(ready=not args.train_only_td3 and len(manager_buffer) > 0)
+                    if n_updates:
+                        man_schedule.run(lambda n: train_manager(n, total_timesteps), n_updates)
 
                     print("TB dir:", output_dir)
                     print("*************")
@@ -946,25 +1042,31 @@ def run_hrac(args):
                                     cost_model.save("./models", args.env_name, args.algo, exp_num)
                             if args.world_model:
                                 predict_env.save("./models", args.env_name, args.algo, exp_num)
+                        flush_buffers()
 
                     if traj_buffer.full():
-                        n_states, a_loss = update_amat_and_train_anet(n_states, adj_mat, state_list, state_dict, a_net, traj_buffer,
+                        a_loss = update_amat_and_train_anet(graph, a_net, traj_buffer,
                             optimizer_r, controller_goal_dim, device, args, exp_num)
-                        
-                        writer.add_scalar("data/a_net_loss", a_loss, total_timesteps)
+                        if a_loss is not None:
+                            writer.add_scalar("data/a_net_loss", a_loss, total_timesteps)
 
 
                     if not args.train_only_td3 and len(manager_transition[-2]) != 1:                    
-                        manager_transition[1] = state
+                        manager_transition[1] = state_ref
                         manager_transition[5] = float(True)
                         manager_buffer.add(manager_transition)
+                elif just_loaded:
+                    # nothing is trained on the first episode after --load, nor later on its behalf
+                    for schedule in [cm_schedule, ctrl_schedule, man_schedule]:
+                        schedule.drop_pending()
 
                 obs = env.reset()
 
                 goal = obs["desired_goal"]
                 state = obs["observation"]
+                state_ref = store_obs(state)
                 traj_buffer.create_new_trajectory()
-                traj_buffer.append(state)
+                traj_buffer.append(state_ref)
                 if args.domain_name == "Safexp" and args.cost_model:
                     if not args.cost_oracle:
                         if len(cost_model_buffer.trajectory) != 0:
@@ -1000,7 +1102,7 @@ def run_hrac(args):
                             min_action=np.zeros(controller_goal_dim), max_action=2*man_scale[:controller_goal_dim])
 
                     timesteps_since_subgoal = 0
-                    manager_transition = [state, None, goal, subgoal, 0, False, [state], []]
+                    manager_transition = [state_ref, None, goal, subgoal, 0, False, [state_ref], []]
 
             if args.train_only_td3:
                 controller_goal = goal[:controller_policy.goal_dim] - state[:controller_policy.goal_dim]
@@ -1023,10 +1125,11 @@ def run_hrac(args):
 
             next_goal = next_tup["desired_goal"]
             next_state = next_tup["observation"]
+            next_state_ref = store_obs(next_state)
 
             if not args.train_only_td3:
-                manager_transition[-2].append(next_state)
-            traj_buffer.append(next_state)
+                manager_transition[-2].append(next_state_ref)
+            traj_buffer.append(next_state_ref)
 
             if args.train_only_td3:
                 controller_goal = goal[:controller_policy.goal_dim] - state[:controller_policy.goal_dim]
@@ -1052,30 +1155,52 @@ def run_hrac(args):
 
             if args.domain_name == "Safexp" and args.cost_model:
                 if not args.cost_oracle:
-                    cost_model_buffer.append(next_state, info["safety_cost"])
+                    cost_model_buffer.append(next_state_ref, info["safety_cost"])
 
             if args.world_model:
                 if world_model_buffer.cost_memmory:
                     world_model_buffer.add(
-                        (state, next_state, controller_goal, action, controller_reward, info["safety_cost"], float(ctrl_done), [], []))
+                        (state_ref, next_state_ref, controller_goal, action, controller_reward, info["safety_cost"], float(ctrl_done), [], []))
                 else:
                     world_model_buffer.add(
-                        (state, next_state, controller_goal, action, controller_reward, float(ctrl_done), [], []))
+                        (state_ref, next_state_ref, controller_goal, action, controller_reward, float(ctrl_done), [], []))
             if controller_buffer.cost_memmory:
                 controller_buffer.add(
-                    (state, next_state, controller_goal, action, controller_reward, info["safety_cost"], float(ctrl_done), [], []))
+                    (state_ref, next_state_ref, controller_goal, action, controller_reward, info["safety_cost"], float(ctrl_done), [], []))
             else:
                 controller_buffer.add(
-                    (state, next_state, controller_goal, action, controller_reward, float(ctrl_done), [], []))
+                    (state_ref, next_state_ref, controller_goal, action, controller_reward, float(ctrl_done), [], []))
+
+            ## Per-step updates, mid-episode cost model training needs the
+            ## streaming cost model buffer
+            n_updates = cm_schedule.step(ready=args.cost_model and not args.cost_oracle and args.cm_train_freq > 0 \
+                                               and len(cost_model_buffer) > 0)
+            if n_updates:
+                cm_schedule.run(lambda n: train_cost_model(cost_model_buffer,
+                                                          cost_model_iterations=n,
+                                                          cost_model_batch_size=args.cost_model_batch_size,
+                                                          total_timesteps=total_timesteps,
+                                                          train_on_dataset=args.cm_train_on_dataset,
+                                                          dataset=env.safe_dataset if env_name == "SafeGym" else None,
+                                                          episode_num=episode_num),
+                                n_updates)
+            n_updates = ctrl_schedule.step()
+            if n_updates:
+                ctrl_schedule.run(lambda n: train_controller(n, total_timesteps, 
+                                    pid_costs=pid_costs if controller_policy.use_lagrange else None),
+                                  n_updates)
+            n_updates = man_schedule.step(ready=not args.train_only_td3 and len(manager_buffer) > 0)
+            if n_updates:
+                man_schedule.run(lambda n: train_manager(n, total_timesteps), n_updates)
 
             state = next_state
+            state_ref = next_state_ref
             goal = next_goal
 
             episode_timesteps += 1
             total_timesteps += 1
             timesteps_since_eval += 1
             if not args.train_only_td3:
-                timesteps_since_manager += 1
                 timesteps_since_subgoal += 1
             if done:
                 if args.controller_imagination_safety_loss and args.controller_use_lagrange:
@@ -1099,7 +1224,7 @@ def run_hrac(args):
             prev_action = action_copy
 
             if not args.train_only_td3 and timesteps_since_subgoal % args.manager_propose_freq == 0:
-                manager_transition[1] = state
+                manager_transition[1] = state_ref
                 manager_transition[5] = float(done)
 
                 manager_buffer.add(manager_transition)
@@ -1122,7 +1247,7 @@ def run_hrac(args):
                         min_action=np.zeros(controller_goal_dim), max_action=2*man_scale[:controller_goal_dim])
 
                 timesteps_since_subgoal = 0
-                manager_transition = [state, None, goal, subgoal, 0, False, [state], []]
+                manager_transition = [state_ref, None, goal, subgoal, 0, False, [state_ref], []]
 
         ## Final evaluation
         avg_ep_rew, avg_ep_cost, avg_controller_rew, avg_steps, avg_env_finish, validation_date = evaluate_policy(
@@ -1147,9 +1272,11 @@ def run_hrac(args):
                     cost_model.save("./models", args.env_name, args.algo, exp_num)
             if args.world_model:
                 predict_env.save("./models", args.env_name, args.algo, exp_num)
+        flush_buffers()
 
         writer.close()
 
         output_df = pd.DataFrame(output_data)
         output_df.to_csv(os.path.join("./results", file_name+".csv"), float_format="%.4f", index=False)
         print("Training finished.")
+        close_buffers()
@@ -1,9 +1,17 @@
+import os
+import json
+import time
+import queue
 import random
+import shutil
+import threading
+from multiprocessing import shared_memory
+from collections import deque
+from collections.abc import Sequence
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.data as Data
 
 import numpy as np
 
@@ -11,203 +19,954 @@ import numpy as np
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
+# SafeGym hazard lidar readings lie in [0, 1]: a codec keeps those columns of
+# a row as uint8 (steps of 1/255) or float16 and the rest of the row as float32
+class LidarCodec(object):
+    def __init__(self, dtype="uint8", columns=slice(-16, None)):
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in (np.uint8, np.float16), "lidar codec is uint8 or float16"
+        self.columns = columns
+        self.layouts = {}
+
+    @classmethod
+    def for_cost_model(cls, dtype="uint8", frame_stack_num=1):
+        # cost model rows are [goal xy, (agent xy, lidar) * frame_stack_num]
+        return cls(dtype, np.concatenate([4 + 18 * k + np.arange(16) for k in range(frame_stack_num)]))
+
+    def _layout(self, width):
+        if width not in self.layouts:
+            lidar = np.arange(width)[self.columns]
+            self.layouts[width] = lidar, np.setdiff1d(np.arange(width), lidar)
+        return self.layouts[width]
+
+    def encode(self, rows):
+        rows = np.asarray(rows, dtype=np.float32)
+        lidar, rest = self._layout(rows.shape[-1])
+        lidar_values = rows[..., lidar]
+        if self.dtype == np.uint8:
+            lidar_values = np.rint(np.clip(lidar_values, 0, 1) * 255)
+        return rows[..., rest], lidar_values.astype(self.dtype)
+
+    def decode(self, rest_values, lidar_values):
+        width = rest_values.shape[-1] + lidar_values.shape[-1]
+        lidar, rest = self._layout(width)
+        rows = np.empty(rest_values.shape[:-1] + (width,), dtype=np.float32)
+        rows[..., rest] = rest_values
+        rows[..., lidar] = lidar_values
+        if self.dtype == np.uint8:
+            rows[..., lidar] /= 255
+        return rows
+
+
+# Read-only sequence of encoded rows, e.g. the states of the safe dataset
+class EncodedRows(Sequence):
+    def __init__(self, codec, rows):
+        self.codec = codec
+        self.rest_values, self.lidar_values = codec.encode(rows)
+
+    def __len__(self):
+        return len(self.rest_values)
+
+    def __getitem__(self, ind):
+        return self.codec.decode(self.rest_values[ind], self.lidar_values[ind])
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+
+# Observations shared by several buffers, each environment state is kept once
+class ObservationStore(object):
+    counters = ("next_id",)
+
+    def __init__(self, maxsize=1e6, codec=None):
+        self.maxsize = int(maxsize)
+        self.codec = codec
+        self.clear()
+
+    def clear(self):
+        self.storage = {}
+        # ids are global step counters, id % maxsize is the row
+        self.next_id = 0
+
+    def _alloc(self, key, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def _write(self, key, row, datapoint):
+        if key not in self.storage:
+            self.storage[key] = self._alloc(key, (self.maxsize,) + datapoint.shape, datapoint.dtype)
+        self.storage[key][row] = datapoint
+
+    def add(self, obs):
+        obs = np.asarray(obs, dtype=np.float32)
+        row = self.next_id % self.maxsize
+        if self.codec is not None:
+            obs, lidar = self.codec.encode(obs)
+            self._write("obs_lidar", row, lidar)
+        self._write("obs", row, obs)
+        self.next_id += 1
+        return self.next_id - 1
+
+    def get(self, ids):
+        rows = np.asarray(ids, dtype=np.int64) % self.maxsize
+        if self.codec is not None:
+            return self.codec.decode(self.storage["obs"][rows], self.storage["obs_lidar"][rows])
+        return self.storage["obs"][rows]
+
+    def __len__(self):
+        return min(self.next_id, self.maxsize)
+
+
 # Simple replay buffer
 class ReplayBuffer(object):
-    def __init__(self, maxsize=1e6, cost_memmory=False):
+    counters = ("next_idx", "size")
+    prioritized = False
+
+    def __init__(self, maxsize=1e6, cost_memmory=False, obs_store=None, seq_len=None, codec=None):
         self.name = "simple_buffer"
         self.cost_memmory = cost_memmory
         if cost_memmory:
-            self.storage = [[] for _ in range(9)]
+            self.fields = ["x", "y", "g", "u", "r", "c", "d"]
         else:
-            self.storage = [[] for _ in range(8)]
-        self.maxsize = maxsize
-        self.next_idx = 0
+            self.fields = ["x", "y", "g", "u", "r", "d"]
+        # x_seq/a_seq are kept only for off-policy goal correction, as fixed
+        # (seq_len + 1, obs_dim) / (seq_len, action_dim) segments per transition
+        self.seq_len = seq_len
+        if seq_len is not None:
+            self.fields = self.fields + ["x_seq", "a_seq"]
+        # with an ObservationStore, x, x' and x_seq hold ids into it
+        self.obs_store = obs_store
+        self.obs_fields = ["x", "y", "x_seq"] if obs_store is not None else []
+        # otherwise a codec may compact the lidar part of the observations
+        self.codec = codec
+        self.codec_fields = ["x", "y", "x_seq"] if codec is not None and obs_store is None else []
+        self.maxsize = int(maxsize)
+        self.clear()
 
     def clear(self):
-        if self.cost_memmory:
-            self.storage = [[] for _ in range(9)]    
-        else:
-            self.storage = [[] for _ in range(8)]
+        # one contiguous column per field, allocated from the first add()
+        self.storage = {}
         self.next_idx = 0
+        self.size = 0
+
+    def _alloc(self, key, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def _write(self, key, idx, datapoint):
+        # None marks a field that is unknown for this transition,
+        # rows written before a column exists stay zero
+        if datapoint is None:
+            return
+        dtype = np.int64 if key in self.obs_fields else np.float32
+        datapoint = np.asarray(datapoint, dtype=dtype)
+        if key in self.codec_fields:
+            datapoint, lidar = self.codec.encode(datapoint)
+            self._write_column(key + "_lidar", idx, lidar)
+        self._write_column(key, idx, datapoint)
+
+    def _write_column(self, key, idx, datapoint):
+        if key not in self.storage:
+            self.storage[key] = self._alloc(key, (self.maxsize,) + datapoint.shape, datapoint.dtype)
+        self.storage[key][idx] = datapoint
+
+    def _gather(self, key, ind):
+        if key not in self.storage:
+            return None
+        column = self.storage[key][ind]
+        if key in self.obs_fields:
+            column = self.obs_store.get(column)
+        elif key in self.codec_fields:
+            column = self.codec.decode(column, self.storage[key + "_lidar"][ind])
+        return column
+
+    def _pad_seq(self, x_seq, a_seq):
+        # A segment cut short by the end of an episode is padded explicitly:
+        # x_seq repeats its last observation so x_seq[-1] stays the final state,
+        # a_seq is filled with +inf so that off_policy_corrections sees a -inf
+        # action difference there and drops it from the log-probability.
+        x_seq = np.asarray(x_seq)
+        a_seq = np.asarray(a_seq, dtype=np.float32)
+        x_pad = self.seq_len + 1 - len(x_seq)
+        a_pad = self.seq_len - len(a_seq)
+        assert x_pad >= 0 and a_pad >= 0, "sequence is longer than seq_len"
+        if x_pad > 0:
+            x_seq = np.concatenate([x_seq, np.repeat(x_seq[-1:], x_pad, axis=0)], axis=0)
+        if a_pad > 0:
+            a_seq = np.concatenate([a_seq, np.full((a_pad,) + a_seq.shape[1:], np.inf, dtype=np.float32)], axis=0)
+        return x_seq, a_seq
 
     # Expects tuples of (x, x', g, u, r, d, x_seq, a_seq)
     def add(self, data):
-        self.next_idx = int(self.next_idx)
-        if self.next_idx >= len(self.storage[0]):
-            [array.append(datapoint) for array, datapoint in zip(self.storage, data)]
-        else:
-            [array.__setitem__(self.next_idx, datapoint) for array, datapoint in zip(self.storage, data)]
+        idx = self.next_idx
+        data = list(data)
+        if self.seq_len is not None:
+            data[-2], data[-1] = self._pad_seq(data[-2], data[-1])
+        for key, datapoint in zip(self.fields, data):
+            self._write(key, idx, datapoint)
 
         self.next_idx = (self.next_idx + 1) % self.maxsize
+        self.size = min(self.size + 1, self.maxsize)
+
+    def _sample_idxes(self, batch_size, iterations=None):
+        shape = (batch_size,) if iterations is None else (iterations, batch_size)
+        if self.size <= batch_size:
+            return np.broadcast_to(np.arange(self.size), shape[:-1] + (self.size,))
+        return np.random.randint(0, self.size, size=shape)
+
+    def _sample_columns(self, ind):
+        batch = []
+        for key in self.fields:
+            column = self._gather(key, ind)
+            if column is not None and key in ("r", "c", "d"):
+                column = column.reshape(ind.shape + (1,))
+            batch.append(column)
+        if self.seq_len is None:
+            batch.extend([None, None])
+
+        return tuple(batch)
 
     def sample(self, batch_size):
-        if len(self.storage[0]) <= batch_size:
-            ind = np.arange(len(self.storage[0]))
-        else:
-            ind = np.random.randint(0, len(self.storage[0]), size=batch_size)
-
-        if self.cost_memmory:
-            x, y, g, u, r, c, d, x_seq, a_seq = [], [], [], [], [], [], [], [], []          
-        else:
-            x, y, g, u, r, d, x_seq, a_seq = [], [], [], [], [], [], [], []          
+        return self._sample_columns(self._sample_idxes(batch_size))
 
-        for i in ind: 
-            if self.cost_memmory:
-                X, Y, G, U, R, C, D, obs_seq, acts = (array[i] for array in self.storage)
-            else:
-                X, Y, G, U, R, D, obs_seq, acts = (array[i] for array in self.storage)
-            x.append(np.array(X, copy=False))
-            y.append(np.array(Y, copy=False))
-            g.append(np.array(G, copy=False))
-            u.append(np.array(U, copy=False))
-            r.append(np.array(R, copy=False))
-            if self.cost_memmory:
-                c.append(np.array(C, copy=False))    
-            d.append(np.array(D, copy=False))
-
-            # For off-policy goal correction
-            x_seq.append(np.array(obs_seq, copy=False))
-            a_seq.append(np.array(acts, copy=False))
-        
-        if self.cost_memmory:
-            return np.array(x), np.array(y), np.array(g), \
-                np.array(u), np.array(r).reshape(-1, 1), np.array(c).reshape(-1, 1), \
-                np.array(d).reshape(-1, 1), \
-                x_seq, a_seq
-        else:
-            return np.array(x), np.array(y), np.array(g), \
-                np.array(u), np.array(r).reshape(-1, 1), np.array(d).reshape(-1, 1), \
-                x_seq, a_seq
+    def sample_many(self, iterations, batch_size):
+        # all indices of a multi-iteration update at once, every column is
+        # gathered as one (iterations, batch_size, ...) block
+        return self._sample_columns(self._sample_idxes(batch_size, iterations))
 
     def save(self, file):
-        np.savez_compressed(file, idx=np.array([self.next_idx]), x=self.storage[0],
-                            y=self.storage[1], g=self.storage[2], u=self.storage[3],
-                            r=self.storage[4], d=self.storage[5], xseq=self.storage[6],
-                            aseq=self.storage[7])
+        columns = {key: self.storage[key][:self.size] for key in self.storage}
+        np.savez_compressed(file, idx=np.array([self.next_idx, self.size]), **columns)
 
     def load(self, file):
+        self.clear()
         with np.load(file) as data:
-            self.next_idx = int(data['idx'][0])
-            self.storage = [data['x'], data['y'], data['g'], data['u'], data['r'],
-                            data['d'], data['xseq'], data['aseq']]
-            self.storage = [list(l) for l in self.storage]
+            self.next_idx, self.size = (int(v) for v in data['idx'])
+            for key in data.files:
+                if key != "idx":
+                    column = data[key]
+                    self.storage[key] = self._alloc(key, (self.maxsize,) + column.shape[1:], column.dtype)
+                    self.storage[key][:len(column)] = column
 
     def __len__(self):
-        return len(self.storage[0])
+        return self.size
     
 
 class CostModelTrajectoryBuffer(object):
+    counters = ("next_idx", "size")
+    prioritized = False
 
-    def __init__(self, maxsize, frame_stack_num=1):
-        self.maxsize = maxsize
+    def __init__(self, maxsize, frame_stack_num=1, obs_store=None, reservoir_size=0, codec=None):
+        self.maxsize = int(maxsize)
         self.frame_stack_num = frame_stack_num
-        self.next_idx = 0
+        self.obs_store = obs_store
+        self.codec = codec
+        # streaming mode: instead of pairing a whole trajectory at its end,
+        # append() keeps bounded reservoirs of step features and of safe/unsafe
+        # goals of the current episode and emits one balanced pair per step
+        self.reservoir_size = int(reservoir_size)
+        self.clear_reservoirs()
+        self.frames = deque(maxlen=frame_stack_num)
         self.trajectory = []
-        self.storage = [[] for _ in range(2)]
         self.name = "cost_trajectory_buffer"
+        self.clear()
 
     def __len__(self):
-        return len(self.storage[0])
+        return self.size
     
     def clear(self):
-        self.storage = [[] for _ in range(2)]    
+        # (state, cost) pairs in two float32 columns allocated from the first add()
+        self.storage = {}
         self.next_idx = 0
+        self.size = 0
+
+    def _alloc(self, key, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def clear_reservoirs(self):
+        self.reservoirs = {}
+        self.reservoir_seen = {"features": 0, "unsafe": 0, "safe": 0}
 
     def create_new_trajectory(self):
         del self.trajectory
         self.trajectory = []
+        self.frames.clear()
+        # goals are labelled under the hazard layout of their own episode,
+        # so pairs never mix steps of different episodes
+        self.clear_reservoirs()
 
     def append(self, s, cost):
-        self.trajectory.append((s, cost))
+        if self.reservoir_size:
+            self._stream(s, cost)
+        else:
+            self.trajectory.append((s, cost))
+
+    def _reservoir_add(self, key, row):
+        seen = self.reservoir_seen[key]
+        slot = seen if seen < self.reservoir_size else random.randrange(seen + 1)
+        if slot < self.reservoir_size:
+            if key not in self.reservoirs:
+                self.reservoirs[key] = np.zeros((self.reservoir_size,) + row.shape, dtype=np.float32)
+            self.reservoirs[key][slot] = row
+        self.reservoir_seen[key] = seen + 1
+
+    def _reservoir_sample(self, key):
+        return self.reservoirs[key][random.randrange(min(self.reservoir_seen[key], self.reservoir_size))]
+
+    def _stream(self, s, cost):
+        if self.obs_store is not None:
+            s = self.obs_store.get([s])[0]
+        s = np.asarray(s, dtype=np.float32)
+        self.frames.append(np.concatenate([s[:2], s[-16:]]))
+        if len(self.frames) < self.frame_stack_num:
+            part_of_state = np.zeros(len(self.frames[0]) * self.frame_stack_num, dtype=np.float32)
+        else:
+            part_of_state = np.concatenate(self.frames)
+        self._reservoir_add("features", part_of_state)
+        self._reservoir_add("unsafe" if cost >= 1 else "safe", s[:2])
+
+        # alternate labels so the emitted pairs stay balanced
+        if self.reservoir_seen["unsafe"] and self.reservoir_seen["safe"]:
+            label = (self.reservoir_seen["features"] % 2 == 0)
+            goal = self._reservoir_sample("unsafe" if label else "safe")
+            self.add((np.concatenate([goal, self._reservoir_sample("features")]), float(label)))
+
+    def _pair_features(self, trajectory_states):
+        # agent xy + lidar of every step, stacked over frame_stack_num frames;
+        # steps without a full stack of history are all zeros
+        steps = np.concatenate([trajectory_states[:, :2], trajectory_states[:, -16:]], axis=1)
+        if self.frame_stack_num == 1:
+            return steps
+        padded = np.concatenate([np.zeros((self.frame_stack_num - 1, steps.shape[1]), dtype=steps.dtype), steps])
+        windows = np.lib.stride_tricks.sliding_window_view(padded, self.frame_stack_num, axis=0)
+        windows = windows.transpose(0, 2, 1).reshape(len(steps), -1).copy()
+        windows[:self.frame_stack_num - 1] = 0
+        return windows
 
     def add_trajectory_to_buffer(self):
+        if len(self.trajectory) == 0:
+            return
+        trajectory_states = [sc_pair[0] for sc_pair in self.trajectory]
+        if self.obs_store is not None:
+            trajectory_states = self.obs_store.get(trajectory_states)
+        trajectory_states = np.asarray(trajectory_states, dtype=np.float32)
+        trajectory_costs = np.asarray([sc_pair[1] for sc_pair in self.trajectory], dtype=np.float32)
+        part_of_state = self._pair_features(trajectory_states)
+
+        # every (i, j) pair is [goal = xy of step j, features of step i] with the
+        # label of step j; only the balanced subset that is kept gets built
+        unsafe_j = np.flatnonzero(trajectory_costs >= 1) # test could be [0, 1, 2]
+        safe_j = np.flatnonzero(trajectory_costs < 1)
+        n = len(trajectory_states)
+        samples_to_add = min(n, n * len(unsafe_j), n * len(safe_j)) // 2
+        if samples_to_add == 0:
+            return
         states = []
-        costs = []
-
-        current_trajectory = self.trajectory
-        unsafe_state = []
-        safe_state = []
-        for i in range(len(current_trajectory)):
-            for j in range(len(current_trajectory)):
-                if self.frame_stack_num > 1:
-                    frame_stack_states_i = [sc_pair[0] for sc_pair in current_trajectory[i-self.frame_stack_num+1:i+1]]
-                else:
-                    state_i = current_trajectory[i][0]
-                _ = current_trajectory[i][1]
-                state_j = current_trajectory[j][0]
-                cost_j = current_trajectory[j][1]
-
-                manager_absolute_goal = state_j[:2]
-                part_of_state = []
-                if self.frame_stack_num > 1:
-                    agent_poses = [state_i[:2] for state_i in frame_stack_states_i]
-                    obstacle_datas = [state_i[-16:] for state_i in frame_stack_states_i]
-                    # if current i < self.frame_stack_num, fill posses, obstacle_datas with zeros
-                    while len(agent_poses) < self.frame_stack_num:
-                        agent_poses.append([0 for i in range(2)])
-                        obstacle_datas.append([0 for i in range(16)])
-                    for agent_pose, obstacle_data in zip(agent_poses, obstacle_datas):
-                        part_of_state.extend(agent_pose)
-                        part_of_state.extend(obstacle_data)
-                else:
-                    agent_pose = state_i[:2]
-                    obstacle_data = state_i[-16:]
-                    part_of_state.extend(agent_pose)
-                    part_of_state.extend(obstacle_data)
-                state = []
-                state.extend(manager_absolute_goal)
-                state.extend(part_of_state)
-                if cost_j >= 1: # test could be [0, 1, 2]                    
-                    unsafe_state.append(state)
-                else:
-                    safe_state.append(state)
-
-        # get equal count of safe & unsafe states
-        # add = trajectory_len samples to buffer
-        min_len = min(len(unsafe_state), len(safe_state))
-        samples_to_add = len(current_trajectory)
-        samples_to_add = min(samples_to_add, min_len) // 2
-        unsafe_state = random.sample(unsafe_state, samples_to_add)
-        safe_state = random.sample(safe_state, samples_to_add)
-
-        states.extend(unsafe_state)
-        states.extend(safe_state)
-        costs.extend([1 for i in range(len(unsafe_state))])
-        costs.extend([0 for i in range(len(safe_state))])
-
-        for state, cost in zip(states, costs):
-            self.add((state, cost))
-        
+        for class_j in (unsafe_j, safe_j):
+            pairs = np.asarray(random.sample(range(n * len(class_j)), samples_to_add))
+            i, j = pairs // len(class_j), class_j[pairs % len(class_j)]
+            states.append(np.concatenate([trajectory_states[j, :2], part_of_state[i]], axis=1))
+        costs = np.concatenate([np.ones(samples_to_add), np.zeros(samples_to_add)])
+        self.add_many(np.concatenate(states), costs)
 
     def add(self, data):
-        self.next_idx = int(self.next_idx)
-        if self.next_idx >= len(self.storage[0]):
-            [array.append(datapoint) for array, datapoint in zip(self.storage, data)]
-        else:
-            [array.__setitem__(self.next_idx, datapoint) for array, datapoint in zip(self.storage, data)]
+        state, cost = data
+        self.add_many(np.asarray(state, dtype=np.float32)[None], [cost])
+
+    def _write(self, key, rows, data):
+        if key not in self.storage:
+            self.storage[key] = self._alloc(key, (self.maxsize,) + data.shape[1:], data.dtype)
+        self.storage[key][rows] = data
+
+    def add_many(self, states, costs):
+        states = np.asarray(states, dtype=np.float32)[-self.maxsize:]
+        costs = np.asarray(costs, dtype=np.float32)[-self.maxsize:]
+        rows = (self.next_idx + np.arange(len(states))) % self.maxsize
+        if self.codec is not None:
+            states, lidar = self.codec.encode(states)
+            self._write("x_lidar", rows, lidar)
+        self._write("x", rows, states)
+        self._write("c", rows, costs)
+
+        self.next_idx = (self.next_idx + len(states)) % self.maxsize
+        self.size = min(self.size + len(states), self.maxsize)
+
+    def _gather_x(self, ind):
+        if self.codec is not None:
+            return self.codec.decode(self.storage["x"][ind], self.storage["x_lidar"][ind])
+        return self.storage["x"][ind]
+
+    def _sample_idxes(self, batch_size, iterations=None):
+        shape = (batch_size,) if iterations is None else (iterations, batch_size)
+        if self.size <= batch_size:
+            return np.broadcast_to(np.arange(self.size), shape[:-1] + (self.size,))
+        return np.random.randint(0, self.size, size=shape)
 
-        self.next_idx = (self.next_idx + 1) % self.maxsize
+    def sample(self, batch_size):
+        ind = self._sample_idxes(batch_size)
+        return self._gather_x(ind), self.storage["c"][ind].reshape(-1, 1)
+
+    def sample_many(self, iterations, batch_size):
+        ind = self._sample_idxes(batch_size, iterations)
+        return self._gather_x(ind), self.storage["c"][ind].reshape(ind.shape + (1,))
+
+
+class MemmapStorage(object):
+    # Mixin for the buffers above: their preallocated columns are np.memmap
+    # files in `directory` and counters/shapes go to meta.json, so a buffer
+    # keeps appending to disk and reopens in O(1) after a restart. With a
+    # `source` directory (a resumed experiment) the columns listed in its
+    # meta.json are opened in place and only the new meta.json is written to
+    # `directory`, the source files are taken over by the new buffer unless
+    # copy_source is set.
+    def _open_memmap(self, directory, source=None, copy_source=False):
+        self.directory = directory
+        self.column_files = {}
+        os.makedirs(directory, exist_ok=True)
+        meta_file = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_file) and source is not None:
+            meta_file = os.path.join(source, "meta.json")
+        if not os.path.exists(meta_file):
+            return
+        meta_dir = os.path.dirname(meta_file)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        # column files are kept relative to the directory of their meta.json
+        files = meta.get("files", {})
+        for key, (shape, dtype) in meta["columns"].items():
+            assert shape[0] == self.maxsize, \
+                "{} was created with maxsize {}".format(meta_dir, shape[0])
+            column_file = os.path.normpath(os.path.join(meta_dir, files.get(key, "{}.dat".format(key))))
+            if copy_source and meta_dir != directory:
+                shutil.copyfile(column_file, self._column_file(key))
+            else:
+                self.column_files[key] = column_file
+            self.storage[key] = np.memmap(self._column_file(key), dtype=dtype,
+                                          mode="r+", shape=tuple(shape))
+        for name in self.counters:
+            setattr(self, name, meta["counters"][name])
+
+    def _column_file(self, key):
+        if key not in self.column_files:
+            self.column_files[key] = os.path.join(self.directory, "{}.dat".format(key))
+        return self.column_files[key]
+
+    def _alloc(self, key, shape, dtype):
+        return np.memmap(self._column_file(key), dtype=dtype, mode="w+", shape=shape)
+
+    def flush(self):
+        for column in self.storage.values():
+            column.flush()
+        meta = {
+            "columns": {key: [list(column.shape), column.dtype.str] for key, column in self.storage.items()},
+            "files": {key: os.path.relpath(self._column_file(key), self.directory) for key in self.storage},
+            "counters": {name: int(getattr(self, name)) for name in self.counters},
+        }
+        meta_file = os.path.join(self.directory, "meta.json")
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_file + ".tmp", meta_file)
+
+
+class MemmapReplayBuffer(MemmapStorage, ReplayBuffer):
+    def __init__(self, directory, *args, source=None, copy_source=False, **kwargs):
+        ReplayBuffer.__init__(self, *args, **kwargs)
+        self._open_memmap(directory, source, copy_source)
+
+
+class MemmapObservationStore(MemmapStorage, ObservationStore):
+    def __init__(self, directory, *args, source=None, copy_source=False, **kwargs):
+        ObservationStore.__init__(self, *args, **kwargs)
+        self._open_memmap(directory, source, copy_source)
+
+
+class MemmapCostModelTrajectoryBuffer(MemmapStorage, CostModelTrajectoryBuffer):
+    def __init__(self, directory, *args, source=None, copy_source=False, **kwargs):
+        CostModelTrajectoryBuffer.__init__(self, *args, **kwargs)
+        self._open_memmap(directory, source, copy_source)
+
+
+class TorchReplayBuffer(ReplayBuffer):
+    # ReplayBuffer whose columns are preallocated torch tensors on the training
+    # device: add() writes rows in place and sample()/sample_many() return
+    # tensors gathered with index_select, skipping the NumPy round trip.
+    def __init__(self, *args, **kwargs):
+        ReplayBuffer.__init__(self, *args, **kwargs)
+        assert self.obs_store is None and self.codec is None, \
+            "device buffers keep their own float32 observations"
+
+    def _alloc(self, key, shape, dtype):
+        return torch.zeros(shape, dtype=torch.float32, device=device)
+
+    def _write(self, key, idx, datapoint):
+        if datapoint is None:
+            return
+        datapoint = torch.as_tensor(np.asarray(datapoint, dtype=np.float32), device=device)
+        if key not in self.storage:
+            self.storage[key] = self._alloc(key, (self.maxsize,) + tuple(datapoint.shape), np.float32)
+        self.storage[key][idx] = datapoint
+
+    def _gather(self, key, ind):
+        if key not in self.storage:
+            return None
+        column = self.storage[key]
+        return column.index_select(0, ind.reshape(-1)).reshape(tuple(ind.shape) + tuple(column.shape[1:]))
+
+    def _sample_idxes(self, batch_size, iterations=None):
+        shape = (batch_size,) if iterations is None else (iterations, batch_size)
+        if self.size <= batch_size:
+            return torch.arange(self.size, device=device).expand(shape[:-1] + (self.size,))
+        return torch.randint(0, self.size, shape, device=device)
 
+    def save(self, file):
+        columns = {key: self.storage[key][:self.size].cpu().numpy() for key in self.storage}
+        np.savez_compressed(file, idx=np.array([self.next_idx, self.size]), **columns)
 
-    def sample(self, batch_size):
-        if len(self.storage[0]) <= batch_size:
-            ind = np.arange(len(self.storage[0]))
+    def load(self, file):
+        self.clear()
+        with np.load(file) as data:
+            self.next_idx, self.size = (int(v) for v in data['idx'])
+            for key in self.fields:
+                if key in data:
+                    column = torch.as_tensor(data[key], dtype=torch.float32, device=device)
+                    self.storage[key] = self._alloc(key, (self.maxsize,) + tuple(column.shape[1:]), np.float32)
+                    self.storage[key][:len(column)] = column
+
+
+class SumTree(object):
+    # Array-based binary sum-tree: leaf i holds the priority of row i and
+    # every inner node the sum of its children, so prefix-sum search and
+    # updates are O(log N) each and vectorized over a batch.
+    def __init__(self, capacity):
+        self.leaf_offset = 1
+        while self.leaf_offset < capacity:
+            self.leaf_offset *= 2
+        self.tree = np.zeros(2 * self.leaf_offset, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idxes):
+        return self.tree[np.asarray(idxes) + self.leaf_offset]
+
+    def update(self, idxes, priorities):
+        pos = np.asarray(idxes, dtype=np.int64).reshape(-1) + self.leaf_offset
+        self.tree[pos] = priorities
+        # all leaves are on the same level, so parents are updated level by level
+        while pos[0] > 1:
+            pos = np.unique(pos // 2)
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+
+    def find(self, values):
+        # index of the leaf where the prefix sum reaches each value
+        values = np.array(values, dtype=np.float64).reshape(-1)
+        pos = np.ones(len(values), dtype=np.int64)
+        while pos[0] < self.leaf_offset:
+            left = 2 * pos
+            go_right = values > self.tree[left]
+            values -= self.tree[left] * go_right
+            pos = left + go_right
+        return pos - self.leaf_offset
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    # Proportional prioritized replay. sample()/sample_many() append the
+    # importance weights (.., 1) and the row indices to the usual tuple;
+    # the learner passes |TD error| of those rows to update_priorities().
+    prioritized = True
+
+    def __init__(self, *args, alpha=0.6, beta=0.4, eps=1e-6, **kwargs):
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        ReplayBuffer.__init__(self, *args, **kwargs)
+
+    def clear(self):
+        ReplayBuffer.clear(self)
+        self.tree = SumTree(self.maxsize)
+        self.max_priority = 1.0
+
+    def add(self, data):
+        idx = self.next_idx
+        ReplayBuffer.add(self, data)
+        self.tree.update([idx], self.max_priority ** self.alpha)
+
+    def _sample_idxes(self, batch_size, iterations=None):
+        shape = (batch_size,) if iterations is None else (iterations, batch_size)
+        # stratified: one draw from each of batch_size equal slices of the total priority
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=shape)) * segment
+        return np.minimum(self.tree.find(values), self.size - 1).reshape(shape)
+
+    def _sample_columns(self, ind):
+        batch = ReplayBuffer._sample_columns(self, ind)
+        probs = self.tree.get(ind) / self.tree.total()
+        weights = (self.size * probs) ** -self.beta
+        weights /= weights.max(axis=-1, keepdims=True)
+        return batch + (weights[..., None].astype(np.float32), ind)
+
+    def update_priorities(self, idxes, td_errors):
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)).reshape(-1) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(idxes, priorities ** self.alpha)
+
+
+class SharedMemoryReplayBuffer(ReplayBuffer):
+    # ReplayBuffer whose columns live in multiprocessing.shared_memory, so that
+    # collector processes append transitions that the learner samples without
+    # pickling. Columns are allocated up front from the state/goal/action dims.
+    # The ring is split into one segment per writer, each writer owns the
+    # [next_idx, size] cursor of its segment and publishes a row by bumping
+    # size only after writing it, so appends need no lock. A writer that has
+    # wrapped around overwrites rows a reader may be gathering, so every row
+    # carries a version that is odd while the row is written (a seqlock): the
+    # reader gathers again until none of its rows changed underneath it. The
+    # buffer pickles to the names of its blocks: a worker started by the
+    # learner gets it as a Process argument and calls set_writer() before
+    # adding. seq_action_dim is the width of a_seq rows (default action_dim).
+    def __init__(self, state_dim, goal_dim, action_dim, num_writers=1, seq_action_dim=None, **kwargs):
+        self.dims = (state_dim, goal_dim, action_dim, action_dim if seq_action_dim is None else seq_action_dim)
+        self.num_writers = num_writers
+        self.writer_id = 0
+        self.blocks = {}
+        self.owner_pid = os.getpid()
+        ReplayBuffer.__init__(self, **kwargs)
+        assert self.obs_store is None and self.codec is None, \
+            "shared memory buffers keep their own float32 observations"
+        self.segment = self.maxsize // num_writers
+
+    def _shapes(self):
+        state_dim, goal_dim, action_dim, seq_action_dim = self.dims
+        shapes = {"x": (state_dim,), "y": (state_dim,), "g": (goal_dim,), "u": (action_dim,),
+                  "r": (), "c": (), "d": ()}
+        if self.seq_len is not None:
+            shapes["x_seq"] = (self.seq_len + 1, state_dim)
+            shapes["a_seq"] = (self.seq_len, seq_action_dim)
+        return shapes
+
+    def _alloc(self, key, shape, dtype):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.blocks[key] = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        return np.ndarray(shape, dtype=dtype, buffer=self.blocks[key].buf)
+
+    def clear(self):
+        if not self.blocks:
+            self.storage = {}
+            for key in self.fields:
+                self.storage[key] = self._alloc(key, (self.maxsize,) + self._shapes()[key], np.float32)
+            self.cursors = self._alloc("cursors", (self.num_writers, 2), np.int64)
+            self.versions = self._alloc("versions", (self.maxsize,), np.int64)
+        self.cursors[:] = 0
+        self.versions[:] = 0
+
+    def set_writer(self, writer_id):
+        assert 0 <= writer_id < self.num_writers
+        self.writer_id = writer_id
+
+    @property
+    def size(self):
+        return int(self.cursors[:, 1].sum())
+
+    def add(self, data):
+        next_idx, size = (int(v) for v in self.cursors[self.writer_id])
+        idx = self.writer_id * self.segment + next_idx
+        data = list(data)
+        if self.seq_len is not None:
+            data[-2], data[-1] = self._pad_seq(data[-2], data[-1])
+        self.versions[idx] += 1
+        for key, datapoint in zip(self.fields, data):
+            self._write(key, idx, datapoint)
+        self.versions[idx] += 1
+
+        self.cursors[self.writer_id, 1] = min(size + 1, self.segment)
+        self.cursors[self.writer_id, 0] = (next_idx + 1) % self.segment
+
+    def _sample_idxes(self, batch_size, iterations=None):
+        # uniform over the published rows of all segments
+        shape = (batch_size,) if iterations is None else (iterations, batch_size)
+        sizes = self.cursors[:, 1].copy()
+        starts = np.arange(self.num_writers) * self.segment
+        total = int(sizes.sum())
+        if total <= batch_size:
+            rows = np.concatenate([start + np.arange(size) for start, size in zip(starts, sizes)])
+            return np.broadcast_to(rows, shape[:-1] + (total,))
+        u = np.random.randint(0, total, size=shape)
+        ends = np.cumsum(sizes)
+        writer = np.searchsorted(ends, u, side="right")
+        return starts[writer] + u - (ends - sizes)[writer]
+
+    def _sample_columns(self, ind):
+        while True:
+            versions = self.versions[ind]
+            batch = ReplayBuffer._sample_columns(self, ind)
+            if not ((versions % 2 == 1) | (self.versions[ind] != versions)).any():
+                return batch
+
+    def save(self, file):
+        columns = {key: self.storage[key] for key in self.storage}
+        np.savez_compressed(file, cursors=self.cursors, **columns)
+
+    def load(self, file):
+        with np.load(file) as data:
+            for key in self.fields:
+                self.storage[key][:] = data[key]
+            self.cursors[:] = data["cursors"]
+            self.versions[:] = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["blocks"] = {key: block.name for key, block in self.blocks.items()}
+        del state["storage"], state["cursors"], state["versions"]
+        return state
+
+    def __setstate__(self, state):
+        names = state.pop("blocks")
+        self.__dict__.update(state)
+        self.blocks = {key: shared_memory.SharedMemory(name=name) for key, name in names.items()}
+        self.storage = {key: np.ndarray((self.maxsize,) + self._shapes()[key], dtype=np.float32,
+                                        buffer=self.blocks[key].buf) for key in self.fields}
+        self.cursors = np.ndarray((self.num_writers, 2), dtype=np.int64, buffer=self.blocks["cursors"].buf)
+        self.versions = np.ndarray((self.maxsize,), dtype=np.int64, buffer=self.blocks["versions"].buf)
+
+    def close(self):
+        # only the creating process frees the blocks
+        self.storage, self.cursors, self.versions = {}, None, None
+        for block in self.blocks.values():
+            block.close()
+            if os.getpid() == self.owner_pid:
+                block.unlink()
+        self.blocks = {}
+
+
+class SoftUpdate(object):
+    # Polyak averaging of several (net, target) pairs with fused foreach ops
+    # over all their parameters. With update_interval k the targets move on
+    # every k-th call, by the rate compounded over k steps.
+    def __init__(self, pairs, update_interval=1):
+        self.params = [p for net, _ in pairs for p in net.parameters()]
+        self.target_params = [p for _, target_net in pairs for p in target_net.parameters()]
+        assert len(self.params) == len(self.target_params)
+        self.update_interval = update_interval
+        self.steps = 0
+
+    def __call__(self, tau):
+        self.steps += 1
+        if self.steps % self.update_interval != 0:
+            return
+        tau = 1 - (1 - tau) ** self.update_interval
+        with torch.no_grad():
+            torch._foreach_mul_(self.target_params, 1 - tau)
+            torch._foreach_add_(self.target_params, self.params, alpha=tau)
+
+
+class CompiledUpdate(object):
+    # Train-step function (a loss or the imagination rollout) compiled with
+    # torch.compile (inductor), run eagerly on torch builds without it or once
+    # compiling it has failed. Only dynamo/backend failures fall back, errors
+    # of the function itself propagate. recompile_limit raises dynamo's limit
+    # of graphs per function for the calls of this one, e.g. one per horizon.
+    def __init__(self, fn, recompile_limit=None):
+        self.fn = fn
+        self.compiled = torch.compile(fn) if hasattr(torch, "compile") else None
+        self.recompile_limit = recompile_limit
+
+    def _call_compiled(self, *args, **kwargs):
+        if self.recompile_limit is None:
+            return self.compiled(*args, **kwargs)
+        config = torch._dynamo.config
+        name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+        with config.patch(**{name: max(getattr(config, name), self.recompile_limit)}):
+            return self.compiled(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self._call_compiled(*args, **kwargs)
+            except torch._dynamo.exc.TorchDynamoException as e:
+                print("compiled update failed, running eagerly:", e)
+                self.compiled = None
+        return self.fn(*args, **kwargs)
+
+
+def trace_critics(owner, names, state_dim, goal_dim, action_dim):
+    # TorchScript fallback for torch without torch.compile: replaces the
+    # owner's critics by traced modules sharing the same parameters, so the
+    # optimizers, target updates and checkpoints keep working on them
+    example = (torch.zeros(2, state_dim, device=device),
+               torch.zeros(2, goal_dim, device=device),
+               torch.zeros(2, action_dim, device=device))
+    for name in names:
+        net = getattr(owner, name)
+        setattr(owner, name, torch.jit.trace_module(net, {"forward": example, "Q1": example}))
+
+
+class MetricsAccumulator(object):
+    # Running sums of training losses/metrics kept as detached tensors on the
+    # device, read back with a single sync in means()
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, key, value):
+        if torch.is_tensor(value):
+            value = value.detach().float().reshape(())
+        if key in self.sums:
+            self.sums[key] = self.sums[key] + value
         else:
-            ind = np.random.randint(0, len(self.storage[0]), size=batch_size)
+            self.sums[key] = value
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def means(self):
+        keys = list(self.sums)
+        if not keys:
+            return {}
+        sums = torch.stack([torch.as_tensor(self.sums[key], dtype=torch.float32, device=device)
+                            for key in keys]).cpu().tolist()
+        return {key: value / self.counts[key] for key, value in zip(keys, sums)}
+
+
+class UpdateSchedule(object):
+    # Update-to-data ratio of one learner: every collected env step adds
+    # `utd` updates (utd=None: one update per due call, e.g. a full world
+    # model fit). They are paid out on every `every`-th env step
+    # (cadence "step") or episode end (cadence "episode"), fractional ones
+    # carried over. With time_budget > 0 a payout is capped to what fits in
+    # that many seconds at the measured update speed, the rest is dropped.
+    # A learner that can't train yet (ready=False) keeps its allowance.
+    def __init__(self, utd=1.0, cadence="episode", every=1, time_budget=0):
+        assert cadence in ["step", "episode"]
+        self.utd = utd
+        self.cadence = cadence
+        self.every = max(1, every)
+        self.time_budget = time_budget
+        self.steps = 0
+        self.episodes = 0
+        self.pending = 0.
+        self.seconds_per_update = None
+
+    def _pay(self):
+        if self.utd is None:
+            return 1
+        n_updates = int(self.pending + 1e-6)
+        self.pending -= n_updates
+        if self.time_budget > 0 and self.seconds_per_update:
+            n_fit = int(self.time_budget / self.seconds_per_update)
+            if n_fit < n_updates:
+                # capped by the budget: the updates that don't fit are dropped
+                n_updates, self.pending = n_fit, 0.
+        return n_updates
+
+    def step(self, ready=True):
+        # updates due after one env step
+        self.steps += 1
+        if self.utd is not None:
+            self.pending += self.utd
+        if ready and self.cadence == "step" and self.steps % self.every == 0:
+            return self._pay()
+        return 0
+
+    def end_episode(self, ready=True):
+        # updates due at an episode end
+        self.episodes += 1
+        if ready and self.cadence == "episode" and self.episodes % self.every == 0:
+            return self._pay()
+        return 0
+
+    def drop_pending(self):
+        # an episode whose updates are skipped doesn't pass its allowance on
+        if self.cadence == "episode":
+            self.pending = 0.
+
+    def run(self, train_fn, n_updates):
+        start = time.perf_counter()
+        result = train_fn(n_updates)
+        self.seconds_per_update = (time.perf_counter() - start) / max(1, n_updates)
+        return result
+
+
+class PrefetchSampler(object):
+    # Minibatches for one training call: `iterations` batches of float32
+    # tensors. Indices for many iterations are drawn at once with
+    # replay_buffer.sample_many() and every block goes to the device in one
+    # transfer. With prefetch = 0 the call is drawn synchronously in blocks
+    # of at most `block` batches, so a large UTD ratio doesn't gather every
+    # column for all its iterations at once; with prefetch > 0 a worker
+    # thread keeps the next block of `prefetch` batches ready (in pinned
+    # memory on cuda) while the current updates run.
+    # The buffer must not be written meanwhile. Prioritized buffers are
+    # sampled one iteration at a time so every batch sees fresh priorities.
+    # With reuse = k every sampled batch is yielded (as the same tuple) for
+    # k consecutive iterations; prioritized buffers are never reused.
+    def __init__(self, replay_buffer, batch_size, iterations, prefetch=0, reuse=1, block=32):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.iterations = iterations
+        self.prefetch = prefetch
+        self.reuse = max(1, reuse)
+        if replay_buffer.prioritized:
+            self.prefetch = 0
+            self.reuse = 1
+        self.n_batches = -(-iterations // self.reuse)
+        self.max_block = 1 if replay_buffer.prioritized else max(1, block)
+
+    def _to_tensor(self, z):
+        if z is None:
+            return None
+        if torch.is_tensor(z):
+            # device-resident buffer
+            return z
+        if z.dtype.kind in "iu":
+            # row indices of a prioritized sample
+            return torch.from_numpy(z)
+        z = torch.from_numpy(np.ascontiguousarray(z, dtype=np.float32))
+        if device.type == "cuda":
+            z = z.pin_memory()
+        return z
+
+    def _draw(self, iterations):
+        block = self.replay_buffer.sample_many(iterations, self.batch_size)
+        return tuple(self._to_tensor(z) for z in block)
+
+    def _worker(self, blocks):
+        try:
+            remaining = self.n_batches
+            while remaining > 0:
+                iterations = min(self.prefetch, remaining)
+                blocks.put(self._draw(iterations))
+                remaining -= iterations
+        except Exception as e:
+            blocks.put(e)
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            blocks = queue.Queue(maxsize=1)
+            threading.Thread(target=self._worker, args=(blocks,), daemon=True).start()
+        remaining = self.n_batches
+        updates = self.iterations
+        while remaining > 0:
+            if self.prefetch > 0:
+                block = blocks.get()
+                if isinstance(block, Exception):
+                    raise block
+            else:
+                block = self._draw(min(remaining, self.max_block))
+            block = tuple(None if z is None else z.to(device, non_blocking=True) for z in block)
+            iterations = block[0].shape[0]
+            for i in range(iterations):
+                batch = tuple(None if z is None else z[i] for z in block)
+                for _ in range(min(self.reuse, updates)):
+                    yield batch
+                updates -= self.reuse
+            remaining -= iterations
 
-        x, c  = [], []
+    def __len__(self):
+        return self.iterations
 
-        for i in ind: 
-            X, C  = (array[i] for array in self.storage)
-            x.append(np.array(X, copy=False))
-            c.append(np.array(C, copy=False))    
-        
-        return np.array(x), np.array(c).reshape(-1, 1)
 
 class TrajectoryBuffer(object):
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, obs_store=None):
         self._capacity = capacity
+        self.obs_store = obs_store
         self.reset()
 
     def reset(self):
@@ -236,6 +995,8 @@ class TrajectoryBuffer(object):
         self._size += 1
 
     def get_trajectory(self):
+        if self.obs_store is not None:
+            return [self.obs_store.get(traj) for traj in self.trajectory]
         return self.trajectory
 
     def set_capacity(self, new_capacity):
@@ -271,27 +1032,165 @@ class OUNoise(object):
         return (self.X + action).clip(min_action, max_action)
 
 
-def train_adj_net(a_net, states, adj_mat, optimizer, margin_pos, margin_neg,
+class AdjacencyGraph(object):
+    # Explored cells of the discretized goal space and the k-step reachability
+    # between them: a dict from cell to id plus growable arrays of cells and of
+    # undirected COO edges (each cell is implicitly adjacent to itself).
+    def __init__(self, goal_dim, capacity=1024):
+        self.index = {}
+        self.cells = np.zeros((capacity, goal_dim), dtype=np.int32)
+        self.edges = np.zeros((capacity, 2), dtype=np.int64)
+        # sorted (i << 32 | j) keys of the edges with i < j
+        self.edge_keys = np.zeros(0, dtype=np.int64)
+        self.n_states = 0
+        self.n_edges = 0
+        # cells and edges appended after these counts are new since the last
+        # adjacency network update
+        self.trained_states = 0
+        self.trained_edges = 0
+
+    def mark_trained(self):
+        self.trained_states = self.n_states
+        self.trained_edges = self.n_edges
+
+    def _grow(self, array, size):
+        if size <= len(array):
+            return array
+        grown = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add_cells(self, cells):
+        # ids of the rows of `cells`, unseen cells get the next free ids
+        unique, inverse = np.unique(np.asarray(cells, dtype=np.int32), axis=0, return_inverse=True)
+        ids = np.empty(len(unique), dtype=np.int64)
+        for k, cell in enumerate(map(tuple, unique.tolist())):
+            if cell not in self.index:
+                self.index[cell] = self.n_states
+                self.cells = self._grow(self.cells, self.n_states + 1)
+                self.cells[self.n_states] = cell
+                self.n_states += 1
+            ids[k] = self.index[cell]
+        return ids[inverse.reshape(-1)]
+
+    def _edge_keys(self, a, b):
+        return np.minimum(a, b) << 32 | np.maximum(a, b)
+
+    def _find(self, keys):
+        pos = np.searchsorted(self.edge_keys, keys)
+        known = pos < len(self.edge_keys)
+        known[known] = self.edge_keys[pos[known]] == keys[known]
+        return pos, known
+
+    def is_edge(self, a, b):
+        return self._find(self._edge_keys(np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)))[1]
+
+    def add_edges(self, cells_a, cells_b):
+        if len(cells_a) == 0:
+            return
+        ids = self.add_cells(np.concatenate([cells_a, cells_b]))
+        a, b = ids[:len(cells_a)], ids[len(cells_a):]
+        keys = np.unique(self._edge_keys(a, b))
+        keys = keys[(keys >> 32) != (keys & 0xffffffff)]
+        pos, known = self._find(keys)
+        new = keys[~known]
+        self.edge_keys = np.insert(self.edge_keys, pos[~known], new)
+        self.edges = self._grow(self.edges, self.n_edges + len(new))
+        self.edges[self.n_edges:self.n_edges + len(new), 0] = new >> 32
+        self.edges[self.n_edges:self.n_edges + len(new), 1] = new & 0xffffffff
+        self.n_edges += len(new)
+
+    def states(self):
+        return self.cells[:self.n_states]
+
+
+class AdjacencyPairSampler(object):
+    # Balanced (x, y, label) minibatches drawn straight from an AdjacencyGraph:
+    # positives are random edges, negatives random pairs of distinct cells that
+    # are rejected while they are edges. Cells go to the device once.
+    # With new_fraction, that share of the positives comes from the edges and
+    # of the negatives' first cells from the cells added since the graph was
+    # last marked trained, the rest replays the older ones.
+    def __init__(self, graph, batch_size, n_batches, scale=1., device='cpu', new_fraction=None):
+        self.graph = graph
+        self.batch_size = batch_size
+        self.n_batches = n_batches
+        self.device = device
+        self.new_fraction = new_fraction
+        self.cells = torch.as_tensor(graph.states(), dtype=torch.float32, device=device) / scale
+
+    def _split(self, size, old, total):
+        # (start, stop, count) ranges to draw `size` items from, new ones first
+        if self.new_fraction is None or old == 0 or old == total:
+            return [(0, total, size)]
+        n_new = int(round(size * self.new_fraction))
+        return [(old, total, n_new), (0, old, size - n_new)]
+
+    def _draw(self, size, old, total):
+        return np.concatenate([np.random.randint(start, stop, size=count)
+                               for start, stop, count in self._split(size, old, total)])
+
+    def _positives(self, size):
+        return self.graph.edges[self._draw(size, self.graph.trained_edges, self.graph.n_edges)]
+
+    def _negatives(self, size):
+        n = self.graph.n_states
+        pairs = []
+        while size > 0:
+            candidates = np.random.randint(0, n, size=(2 * size, 2))
+            candidates[:, 0] = np.random.permutation(self._draw(2 * size, self.graph.trained_states, n))
+            candidates = candidates[candidates[:, 0] != candidates[:, 1]]
+            candidates = candidates[~self.graph.is_edge(candidates[:, 0], candidates[:, 1])][:size]
+            pairs.append(candidates)
+            size -= len(candidates)
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+    def sample(self):
+        n = self.graph.n_states
+        n_negatives = n * (n - 1) // 2 - self.graph.n_edges
+        n_pos = self.batch_size // 2 if n_negatives > 0 else self.batch_size
+        n_pos = n_pos if self.graph.n_edges > 0 else 0
+        pairs = np.concatenate([self._positives(n_pos), self._negatives(self.batch_size - n_pos)])
+        pairs = torch.as_tensor(pairs, device=self.device)
+        label = torch.zeros(self.batch_size, dtype=torch.long, device=self.device)
+        label[:n_pos] = 1
+        return self.cells[pairs[:, 0]], self.cells[pairs[:, 1]], label
+
+    def __iter__(self):
+        if self.graph.n_states < 2:
+            return
+        for _ in range(self.n_batches):
+            yield self.sample()
+
+    def __len__(self):
+        return self.n_batches
+
+
+def train_adj_net(a_net, graph, optimizer, margin_pos, margin_neg,
                   n_epochs=100, batch_size=64, device='cpu', verbose=False,
-                  args=None):
+                  args=None, n_batches=None, new_fraction=None):
+    # by default an epoch sees every edge about once, next to as many
+    # non-adjacent pairs. Nothing to contrast below 2 states: returns None
+    if graph.n_states < 2:
+        return None
+    if n_batches is None:
+        n_batches = max(1, int(np.ceil(2 * graph.n_edges / batch_size)))
+    scale = 1.
+    if args.domain_name == "Safexp" and args.a_net_new_discretization_safety_gym:
+        scale = args.a_net_discretization_koef # from -1.5, 1.5 to 0, 30
+    sampler = AdjacencyPairSampler(graph, batch_size, n_batches,
+                                   scale=scale, device=device, new_fraction=new_fraction)
+    n_batches = len(sampler)
     if verbose:
-        print('Generating training data...')
-    dataset = MetricDataset(states, adj_mat, args=args)
-    if verbose:
-        print('Totally {} training pairs.'.format(len(dataset)))
-    dataloader = Data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0, drop_last=False)
-    n_batches = len(dataloader)
+        print('Totally {} edges between {} states.'.format(graph.n_edges, graph.n_states))
 
     loss_func = ContrastiveLoss(margin_pos, margin_neg)
     epoches_loss = []
 
     for i in range(n_epochs):
         epoch_loss = []
-        for j, data in enumerate(dataloader):
+        for j, data in enumerate(sampler):
             x, y, label = data
-            x = x.float().to(device)
-            y = y.float().to(device)
-            label = label.long().to(device)
             x = a_net(x)
             y = a_net(y)
             loss = args.adj_loss_coef * loss_func(x, y, label)
@@ -323,32 +1222,3 @@ class ContrastiveLoss(nn.Module):
         dist = torch.sqrt(torch.pow(x - y, 2).sum(dim=1) + 1e-12)
         loss = (label * (dist - self.margin_pos).clamp(min=0)).mean() + ((1 - label) * (self.margin_neg - dist).clamp(min=0)).mean()
         return loss
-
-
-class MetricDataset(Data.Dataset):
-
-    def __init__(self, states, adj_mat, args=None):
-        super().__init__()
-        n_samples = adj_mat.shape[0]
-        self.x = []
-        self.y = []
-        self.label = []
-        for i in range(n_samples - 1):
-            for j in range(i + 1, n_samples):
-                s_i = np.array(states[i])
-                s_j = np.array(states[j])
-                if args.domain_name == "Safexp" and args.a_net_new_discretization_safety_gym:
-                    s_i = s_i.astype(float) / args.a_net_discretization_koef # from -1.5, 1.5 to 0, 30
-                    s_j = s_j.astype(float) / args.a_net_discretization_koef # from -1.5, 1.5 to 0, 30
-                self.x.append(s_i)
-                self.y.append(s_j)
-                self.label.append(adj_mat[i, j])
-        self.x = np.array(self.x)
-        self.y = np.array(self.y)
-        self.label = np.array(self.label)
-
-    def __len__(self):
-        return self.x.shape[0]
-
-    def __getitem__(self, idx):
-        return self.x[idx], self.y[idx], self.label[idx]
@@ -39,8 +39,12 @@ class StandardScaler(object):
 
         Returns: None.
         """
-        self.mu = np.mean(data, axis=0, keepdims=True)
-        self.std = np.std(data, axis=0, keepdims=True)
+        if torch.is_tensor(data):
+            self.mu = data.mean(dim=0, keepdim=True).cpu().numpy()
+            self.std = data.std(dim=0, unbiased=False, keepdim=True).cpu().numpy()
+        else:
+            self.mu = np.mean(data, axis=0, keepdims=True)
+            self.std = np.std(data, axis=0, keepdims=True)
         self.std[self.std < 1e-12] = 1.0
 
     def transform(self, data, torch_deviced=False):
@@ -110,12 +114,15 @@ class EnsembleFC(nn.Module):
         pass
 
 
-    def forward(self, input: torch.Tensor) -> torch.Tensor:
+    def forward(self, input: torch.Tensor, members=None) -> torch.Tensor:
         #print("input device:", input.device)
         #print("self.weight device:", self.weight.device)
         #assert 1 == 0
-        w_times_x = torch.bmm(input, self.weight)
-        return torch.add(w_times_x, self.bias[:, None, :])  # w times x + b
+        # members: run input[k] through ensemble member members[k] only
+        weight = self.weight if members is None else self.weight[members]
+        bias = self.bias if members is None else self.bias[members]
+        w_times_x = torch.bmm(input, weight)
+        return torch.add(w_times_x, bias[:, None, :])  # w times x + b
 
     def extra_repr(self) -> str:
         return 'in_features={}, out_features={}, bias={}'.format(
@@ -146,12 +153,12 @@ class EnsembleModel(nn.Module):
         #reporter = MemReporter()
         #reporter.report()
     #@profile
-    def forward(self, x, ret_log_var=False):
-        nn1_output = self.swish(self.nn1(x))
-        nn2_output = self.swish(self.nn2(nn1_output))
-        nn3_output = self.swish(self.nn3(nn2_output))
-        nn4_output = self.swish(self.nn4(nn3_output))
-        nn5_output = self.nn5(nn4_output)
+    def forward(self, x, ret_log_var=False, members=None):
+        nn1_output = self.swish(self.nn1(x, members))
+        nn2_output = self.swish(self.nn2(nn1_output, members))
+        nn3_output = self.swish(self.nn3(nn2_output, members))
+        nn4_output = self.swish(self.nn4(nn3_output, members))
+        nn5_output = self.nn5(nn4_output, members)
 
         mean = nn5_output[:, :, :self.output_dim]
 
@@ -228,16 +235,21 @@ class EnsembleDynamicsModel():
         self._state = {}
         self._snapshots = {i: (None, 1e10) for i in range(self.network_size)}
 
+        # the whole dataset is moved to the device once, batches are gathered there
+        if not torch.is_tensor(inputs):
+            inputs, labels = torch.from_numpy(inputs), torch.from_numpy(labels)
+        inputs, labels = inputs.float().to(device), labels.float().to(device)
+
         num_holdout = int(inputs.shape[0] * holdout_ratio)
-        permutation = np.random.permutation(inputs.shape[0])
+        permutation = torch.randperm(inputs.shape[0], device=device)
         inputs, labels = inputs[permutation], labels[permutation]
 
         train_inputs, train_labels = inputs[num_holdout:], labels[num_holdout:]
         holdout_inputs, holdout_labels = inputs[:num_holdout], labels[:num_holdout]
 
         self.scaler.fit(train_inputs)
-        train_inputs = self.scaler.transform(train_inputs)
-        holdout_inputs = self.scaler.transform(holdout_inputs)
+        train_inputs = self.scaler.transform(train_inputs, torch_deviced=True)
+        holdout_inputs = self.scaler.transform(holdout_inputs, torch_deviced=True)
         #print(train_inputs.shape, holdout_inputs.shape)
         # holdout_inputs = torch.from_numpy(holdout_inputs).float().to(device)
         # holdout_labels = torch.from_numpy(holdout_labels).float().to(device)
@@ -248,7 +260,7 @@ class EnsembleDynamicsModel():
         #print(holdout_inputs.shape)
         for epoch in itertools.count():
             #--------training------------
-            train_idx = np.vstack([np.random.permutation(train_inputs.shape[0]) for _ in range(self.network_size)])
+            train_idx = torch.stack([torch.randperm(train_inputs.shape[0], device=device) for _ in range(self.network_size)])
             #print(train_idx)
             # train_idx = np.vstack([np.arange(train_inputs.shape[0])] for _ in range(self.network_size))
             losses = []
@@ -258,25 +270,25 @@ class EnsembleDynamicsModel():
                 #print("idx shape:", idx.shape)
                 #print("train_inputs[0]:", train_inputs[0])
                 #print("train_inputs shape:", train_inputs.shape)
-                train_input = torch.from_numpy(train_inputs[idx]).float().to(device)
+                train_input = train_inputs[idx]
                 #print(train_input.shape)
                 #print("Size occupied on cuda",sys.getsizeof(train_input))
-                train_label = torch.from_numpy(train_labels[idx]).float().to(device)
+                train_label = train_labels[idx]
 
                 mean, logvar = self.ensemble_model(train_input, ret_log_var=True)
                 loss, mtrain = self.ensemble_model.loss(mean, logvar, train_label)
                 self.ensemble_model.train(loss)
                 losses.append(mtrain)
             #-----validation------------------
-            val_idx = np.vstack([np.random.permutation(holdout_inputs.shape[0]) for _ in range(self.network_size)])
+            val_idx = torch.stack([torch.randperm(holdout_inputs.shape[0], device=device) for _ in range(self.network_size)])
             val_batch_size = 512
             val_losses_list = []
             len_valid = 0
             for start_pos in range(0, holdout_inputs.shape[0], val_batch_size):
                 with torch.no_grad():
                     idx = val_idx[:, start_pos: start_pos + val_batch_size]
-                    val_input = torch.from_numpy(holdout_inputs[idx]).float().to(device)
-                    val_label = torch.from_numpy(holdout_labels[idx]).float().to(device)
+                    val_input = holdout_inputs[idx]
+                    val_label = holdout_labels[idx]
                     holdout_mean, holdout_logvar = self.ensemble_model(val_input, ret_log_var=True)
                     _, holdout_mse_losses = self.ensemble_model.loss(holdout_mean, holdout_logvar, val_label, inc_var_loss=False)
                     holdout_mse_losses = holdout_mse_losses.detach().cpu().numpy()
@@ -351,6 +363,30 @@ class EnsembleDynamicsModel():
             return mean, var
 
 
+    def predict_members(self, inputs, model_idxes, torch_deviced=False):
+        # Mean and variance of one given member per row. Rows are grouped by
+        # member (padded to the largest group) and every group only goes
+        # through its own slice of the ensemble weights.
+        inputs = self.scaler.transform(inputs, torch_deviced=torch_deviced)
+        if not torch_deviced:
+            inputs = torch.from_numpy(inputs).float().to(device)
+        members, group = np.unique(model_idxes, return_inverse=True)
+        order = np.argsort(group, kind="stable")
+        counts = np.bincount(group)
+        slot = np.empty_like(order)
+        slot[order] = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+        group, slot = torch.from_numpy(group).to(device), torch.from_numpy(slot).to(device)
+
+        grouped_inputs = inputs.new_zeros(len(members), counts.max(), inputs.shape[-1])
+        grouped_inputs = grouped_inputs.index_put((group, slot), inputs)
+        mean, var = self.ensemble_model(grouped_inputs, ret_log_var=False,
+                                        members=torch.from_numpy(members).to(device))
+        mean, var = mean[group, slot], var[group, slot]
+        if torch_deviced:
+            return mean, var
+        return mean.detach().cpu().numpy(), var.detach().cpu().numpy()
+
+
 class Swish(nn.Module):
     def __init__(self):
         super(Swish, self).__init__()
@@ -368,6 +404,9 @@ def var(tensor, to_device=True):
 def get_tensor(z, to_device=True):
     if z is None:
         return None
+    if torch.is_tensor(z):
+        z = var(z, to_device)
+        return z.unsqueeze(0) if len(z.shape) == 1 else z
     if z[0].dtype == np.dtype("O"):
         return None
     if len(z.shape) == 1:
@@ -393,9 +432,9 @@ class PredictEnv:
         next_state = get_tensor(y, to_device=False)
 
         delta_state = next_state - state
-        inputs = np.concatenate((state, action), axis=-1)
+        inputs = torch.cat((state, action), dim=-1)
 
-        labels = delta_state.numpy()
+        labels = delta_state
         _, loss = self.model.train(inputs, labels, batch_size=batch_size, holdout_ratio=0.2)
         del state, action, next_state
         
@@ -486,6 +525,19 @@ class PredictEnv:
             inputs = torch.cat((obs, act), dim=-1)
         else:
             inputs = np.concatenate((obs, act), axis=-1)
+        if self.model_type == 'pytorch' and not testing_mean_pred:
+            # only the elite drawn for each row is evaluated
+            batch_size = inputs.shape[0]
+            model_idxes = np.random.choice(self.model.elite_model_idxes, size=batch_size)
+            model_means, model_vars = self.model.predict_members(inputs, model_idxes, torch_deviced=torch_deviced)
+            if deterministic:
+                samples = model_means
+            elif torch_deviced:
+                samples = model_means + torch.randn_like(model_means) * torch.sqrt(model_vars)
+            else:
+                samples = model_means + np.random.normal(size=model_means.shape) * np.sqrt(model_vars)
+            next_obs = samples + obs
+            return next_obs[0] if return_single else next_obs
         if self.model_type == 'pytorch':
             ensemble_model_means, ensemble_model_vars = self.model.predict(inputs, torch_deviced=torch_deviced)
         else:
@@ -631,4 +683,94 @@ class PredictEnv:
             std = np.load("{}/{}/{}_{}_wm_scaler_std.npy".format(dir, exp_num, env_name, algo))
             self.model.scaler.set_mu_std(mu, std)
             elite_model_idxes = np.load("{}/{}/{}_{}_wm_elite_model_idxes.npy".format(dir, exp_num, env_name, algo))
-            self.model.set_elite_model_idxes(elite_model_idxes)
\ No newline at end of file
+            self.model.set_elite_model_idxes(elite_model_idxes)
+
+class ImaginationRollout(nn.Module):
+    # Deterministic world model rollout of the controller towards a batch of
+    # subgoals, kept on the device as one unit (no NumPy, torch.compile-able).
+    # Every step each row moves with a uniformly drawn elite: rows are dealt
+    # to the elites in equal random groups, so a step is one batched pass over
+    # the elite weight slices, taken once per rollout and cut to the mean
+    # outputs. Returns the (H + 1, B, state_dim) trajectory and the (H, B, 1)
+    # safety scores of the cost model at every imagined state (all_steps) or
+    # the (1, B, 1) score of the last one. Without an obs_mask (no_xy off) the
+    # actor sees the imagined states unchanged.
+    def __init__(self, actor, ensemble_model, safe_model, obs_mask, goal_dim,
+                 absolute_goal=False, lidar_observation=False, frame_stack_num=1):
+        super(ImaginationRollout, self).__init__()
+        self.actor = actor
+        self.ensemble_model = ensemble_model
+        self.safe_model = safe_model
+        self.obs_mask = obs_mask
+        self.goal_dim = goal_dim
+        self.absolute_goal = absolute_goal
+        self.lidar_observation = lidar_observation
+        self.frame_stack_num = frame_stack_num
+
+    def _member_layers(self, members):
+        model = self.ensemble_model
+        layers = [(layer.weight[members], layer.bias[members]) for layer in
+                  [model.nn1, model.nn2, model.nn3, model.nn4]]
+        layers.append((model.nn5.weight[members][..., :model.output_dim],
+                       model.nn5.bias[members][..., :model.output_dim]))
+        return layers
+
+    def _mean(self, x, layers):
+        for i, (weight, bias) in enumerate(layers):
+            x = torch.baddbmm(bias[:, None, :], x, weight)
+            if i < len(layers) - 1:
+                x = x * torch.sigmoid(x)
+        return x
+
+    def _delta(self, inputs, layers, mean_over_members):
+        n_members = layers[0][0].shape[0]
+        if mean_over_members:
+            return self._mean(inputs[None].expand(n_members, -1, -1), layers).mean(0)
+        batch_size = inputs.shape[0]
+        group_size = -(-batch_size // n_members)
+        perm = torch.randperm(n_members * group_size, device=inputs.device)
+        inputs = F.pad(inputs, (0, 0, 0, n_members * group_size - batch_size))
+        mean = self._mean(inputs[perm].view(n_members, group_size, -1), layers)
+        return mean.reshape(n_members * group_size, -1)[torch.argsort(perm)][:batch_size]
+
+    def _safety_features(self, trajectory, steps):
+        next_states = trajectory[[h + 1 for h in steps]]
+        if not self.lidar_observation:
+            return next_states
+        agent_pose = next_states[..., :2]
+        if self.frame_stack_num == 1:
+            return torch.cat((agent_pose, agent_pose, next_states[..., -16:]), dim=-1)
+        # frames of step h are the states up to h (as sliced from the list of
+        # imagined states), zero frames fill the window up
+        horizon = trajectory.shape[0] - 1
+        frames = torch.cat((trajectory[:-1, ..., :2], trajectory[:-1, ..., -16:]), dim=-1)
+        frames = torch.cat((frames, torch.zeros_like(frames[:1])), dim=0)
+        windows = []
+        for h in steps:
+            window = list(range(h + 1))[h - self.frame_stack_num + 1:h + 1]
+            windows.append(window + [horizon] * (self.frame_stack_num - len(window)))
+        windows = torch.as_tensor(windows, device=frames.device)
+        frames = frames[windows].permute(0, 2, 1, 3).flatten(start_dim=2)
+        return torch.cat((agent_pose, frames), dim=-1)
+
+    def forward(self, state, subgoal, horizon, mu, std, members, mean_over_members=False, all_steps=True):
+        layers = self._member_layers(members)
+        states = [state]
+        for h in range(horizon):
+            if self.obs_mask is not None:
+                with torch.no_grad():
+                    clean_state = state * self.obs_mask
+            else:
+                clean_state = state
+            action = self.actor(clean_state, subgoal)
+            inputs = (torch.cat((state, action), dim=-1) - mu) / std
+            next_state = state + self._delta(inputs, layers, mean_over_members)
+            if not self.absolute_goal:
+                subgoal = state[:, :self.goal_dim] + subgoal - next_state[:, :self.goal_dim]
+            state = next_state
+            states.append(state)
+        trajectory = torch.stack(states)
+        steps = list(range(horizon)) if all_steps else [horizon - 1]
+        features = self._safety_features(trajectory, steps)
+        safeties = self.safe_model(features.flatten(end_dim=1)).view(len(steps), state.shape[0], -1)
+        return trajectory, safeties
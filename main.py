@@ -51,6 +51,9 @@ if __name__ == "__main__":
     parser.add_argument("--r_margin_neg", default=1.2, type=float)
     parser.add_argument("--r_training_epochs", default=25, type=int)
     parser.add_argument("--r_batch_size", default=64, type=int)
+    parser.add_argument("--r_train_batch_size", default=2048, type=int) # adjacency network minibatch drawn on the device, 0 = r_batch_size (baseline)
+    parser.add_argument("--r_incremental", action='store_true', default=False) # train a_net on new edges + replay of old ones
+    parser.add_argument("--r_incremental_batches", default=100, type=int)
     parser.add_argument("--r_hidden_dim", default=128, type=int)
     parser.add_argument("--r_embedding_dim", default=32, type=int)
 
@@ -70,6 +73,11 @@ if __name__ == "__main__":
     parser.add_argument("--man_crit_lr", default=1e-3, type=float)
     parser.add_argument("--candidate_goals", default=10, type=int)
     parser.add_argument("--man_discount", default=0.99, type=float)
+    parser.add_argument("--man_utd", default=None, type=float) # manager updates per env step, default 1 / train_manager_freq
+    parser.add_argument("--man_update_cadence", default="episode", type=str, choices=["step", "episode"])
+    parser.add_argument("--man_update_every", default=1, type=int) # train on every n-th step/episode end
+    parser.add_argument("--man_update_budget", default=0, type=float) # > 0: cap the updates of one payout to this many seconds
+    parser.add_argument("--man_batch_reuse", default=1, type=int) # consecutive updates on one sampled minibatch
 
     # Controller Parameters
     parser.add_argument("--sac_alpha", default=0.2, type=float)
@@ -78,12 +86,20 @@ if __name__ == "__main__":
     parser.add_argument("--self_td3_reward", action='store_true', default=False)
     parser.add_argument("--controller_grad_clip", default=0, type=float)
     parser.add_argument("--ctrl_soft_sync_rate", default=0.005, type=float)
+    parser.add_argument("--target_update_interval", default=1, type=int) # soft-update manager/controller targets every n updates
+    parser.add_argument("--ensemble_critics", action='store_true', default=False) # twin (and cost) critics as one batched ensemble
+    parser.add_argument("--compile_updates", action='store_true', default=False) # torch.compile the critic/actor losses (TorchScript critics on older torch); gains are small and hardware dependent (td3 can come out slightly slower), measure with benchmark_updates.py
     parser.add_argument("--ctrl_batch_size", default=128, type=int)
     parser.add_argument("--ctrl_buffer_size", default=2e5, type=int)
     parser.add_argument("--ctrl_rew_scale", default=1.0, type=float)
     parser.add_argument("--ctrl_act_lr", default=1e-4, type=float)
     parser.add_argument("--ctrl_crit_lr", default=1e-3, type=float)
     parser.add_argument("--ctrl_discount", default=0.95, type=float)
+    parser.add_argument("--ctrl_utd", default=1., type=float) # controller updates per env step
+    parser.add_argument("--ctrl_update_cadence", default="episode", type=str, choices=["step", "episode"])
+    parser.add_argument("--ctrl_update_every", default=1, type=int) # train on every n-th step/episode end
+    parser.add_argument("--ctrl_update_budget", default=0, type=float) # > 0: cap the updates of one payout to this many seconds
+    parser.add_argument("--ctrl_batch_reuse", default=1, type=int) # consecutive updates on one sampled minibatch
 
     # Safety Subgoal Parameters
     parser.add_argument("--modelfree_safety", action='store_true', default=False)
@@ -98,6 +114,10 @@ if __name__ == "__main__":
     parser.add_argument("--cost_model_buffer_size", default=1e6, type=int)
     parser.add_argument("--cm_lr", default=1e-3, type=float)
     parser.add_argument("--cm_frame_stack_num", default=1, type=int)
+    parser.add_argument("--cm_reservoir_size", default=0, type=int) # > 0: stream balanced pairs from safe/unsafe reservoirs
+    parser.add_argument("--cm_train_freq", default=0, type=int) # > 0: train cost model every n steps instead of per episode
+    parser.add_argument("--cm_utd", default=1., type=float) # cost model updates per env step
+    parser.add_argument("--cm_update_budget", default=0, type=float) # > 0: cap the updates of one payout to this many seconds
     parser.add_argument("--safe_model_loss_coef", default=1., type=float)
 
     # Safety Controller Parameters
@@ -134,6 +154,18 @@ if __name__ == "__main__":
     parser.add_argument("--use_decay", default=True, type=bool)
     parser.add_argument("--testing_mean_wm", action='store_true', default=False)
 
+    # Replay Buffer Parameters
+    parser.add_argument("--obs_store", action='store_true', default=False) # keep each observation once, buffers store ids; sized by the longest buffer horizon in env steps, usually man_buffer_size * manager_propose_freq, so it saves ~1.5x with the default buffer sizes
+    parser.add_argument("--memmap_buffers", action='store_true', default=False) # np.memmap replay in ./models/{exp_num}/replay (needs --save_models), --load reopens the loaded replay in place
+    parser.add_argument("--copy_loaded_replay", action='store_true', default=False) # --load with --memmap_buffers copies the loaded replay instead of taking it over
+    parser.add_argument("--shared_memory_buffers", action='store_true', default=False) # controller/manager replay in multiprocessing.shared_memory, for collector processes
+    parser.add_argument("--device_buffers", action='store_true', default=False) # replay columns as torch tensors on the training device; the SafeGym cost model trajectory buffer stays in host memory (one transfer per sampled block)
+    parser.add_argument("--lidar_codec", default=None, choices=["uint8", "float16"]) # compact storage of the SafeGym lidar channels
+    parser.add_argument("--prioritized_replay", action='store_true', default=False) # sum-tree PER for controller and manager buffers
+    parser.add_argument("--per_alpha", default=0.6, type=float)
+    parser.add_argument("--per_beta", default=0.4, type=float)
+    parser.add_argument("--prefetch_batches", default=0, type=int) # minibatches sampled ahead on a worker thread, 0 = synchronous
+
     # Noise Parameters
     parser.add_argument("--noise_type", default="normal", type=str)
     parser.add_argument("--ctrl_noise_sigma", default=1., type=float)
@@ -169,6 +201,20 @@ if __name__ == "__main__":
           (args.cost_model and args.domain_name != "Safexp" and args.world_model)
         )
 
+    assert not args.device_buffers or not (args.memmap_buffers or args.obs_store), \
+        "device buffers can't be memory-mapped or share an observation store"
+    assert not args.cm_train_freq or (args.domain_name == "Safexp" and args.cm_reservoir_size), \
+        "mid-episode cost model training needs the streaming cost model buffer"
+    assert not args.lidar_codec or (args.domain_name == "Safexp" and not args.device_buffers), \
+        "lidar codec is for SafeGym host-memory buffers"
+    assert not args.prioritized_replay or not (args.memmap_buffers or args.device_buffers), \
+        "prioritized replay is kept in host memory"
+    assert not args.shared_memory_buffers or not (args.memmap_buffers or args.device_buffers or args.obs_store
+                                                  or args.lidar_codec or args.prioritized_replay), \
+        "shared memory buffers keep their own float32 columns"
+    assert not args.memmap_buffers or args.save_models, \
+        "memmap buffers live in ./models/{exp_num}/replay, which needs --save_models"
+
     if args.env_name in ["AntGather", "AntMazeSparse"]:
         args.man_rew_scale = 1.0
         if args.env_name == "AntGather":